@@ -0,0 +1,242 @@
+#these lines import various libraries to use
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+
+from rotsesim.mesa import read_history
+
+#names of the five rsp_Cepheid inlist parameters the library is indexed by
+grid_params = ("RSP_mass", "RSP_L", "RSP_Teff", "RSP_X", "RSP_Z")
+
+#MESA history columns holding the time (days), luminosity, radius and effective temperature of a run, as history_columns.list names them
+default_columns = ("star_age_day", "luminosity", "radius", "effective_T")
+
+#columns of the emulated light curves, named like the inputs of phot_per_sec.py and StarGenerator
+curve_columns = ("star_age_day", "luminosity", "Rstar", "Teff")
+
+#reads the RSP_ parameters of an inlist_rsp_Cepheid file, e.g. RSP_mass = 4.165d0, skipping lines commented out with !
+def read_inlist(filename):
+	params = {}
+	with open(filename) as f:
+		for line in f:
+			match = re.match(r"\s*(RSP_\w+)\s*=\s*([-+0-9.eEdD]+)", line.split("!")[0])
+			if match and match.group(1) in grid_params:
+				params[match.group(1)] = float(match.group(2).lower().replace("d", "e"))
+	return params
+
+#lists the runs of a library as a table of history file names and the five parameters of each run
+#library is either a csv table with a history column (file names relative to the table) and the RSP_ columns, e.g. the --output of Ceph_init_params.py with a history column added,
+#or a list of rsp_Cepheid run directories (or glob patterns), each holding inlist_rsp_Cepheid and LOGS/history.data
+def library_index(library):
+	import pandas as pd
+
+	if isinstance(library, str) and os.path.isfile(library):
+		index = pd.read_csv(library)
+		base = os.path.dirname(os.path.abspath(library))
+		index["history"] = [os.path.join(base, name) for name in index["history"]]
+		return index[["history"] + list(grid_params)]
+
+	if isinstance(library, str):
+		library = [library]
+	rows = []
+	for pattern in library:
+		for run in sorted(glob.glob(pattern)):
+			inlist = os.path.join(run, "inlist_rsp_Cepheid")
+			history = os.path.join(run, "LOGS", "history.data")
+			if os.path.isfile(inlist) and os.path.isfile(history):
+				rows.append(dict(read_inlist(inlist), history=history))
+	return pd.DataFrame(rows, columns=["history"] + list(grid_params))
+
+#times at which y crosses level going upwards, linearly interpolated between samples
+def upward_crossings(t, y, level):
+	i = np.flatnonzero((y[:-1] < level) & (y[1:] >= level))
+	return t[i] + (level - y[i])*(t[i + 1] - t[i])/(y[i + 1] - y[i])
+
+#normalises one MESA light curve by its period and phase
+#the last ncycles full cycles of log L (the stable limit cycle, after the growth of the pulsation) are folded on their mean period and averaged onto nphase equally spaced phases
+#the phase is shifted so the fundamental harmonic of log L peaks at phase 0, which lines up curves of different shapes
+#returns the period in days and an (3, nphase) array of log L, log R and Teff over one cycle
+def curve_template(t, L, R, T, ncycles=10, nphase=256):
+	t, y = np.asarray(t, dtype=float), np.log10(L)
+	level = np.median(y[-len(y)//4:])
+	crossings = upward_crossings(t, y, level)
+	if len(crossings) < 3:
+		raise ValueError("fewer than two pulsation cycles in the light curve")
+	crossings = crossings[-(min(ncycles, len(crossings) - 1) + 1):]
+	period = (crossings[-1] - crossings[0])/(len(crossings) - 1)
+
+	rows = (t >= crossings[0]) & (t < crossings[-1])
+	bins = np.minimum((((t[rows] - crossings[0])/period) % 1*nphase).astype(int), nphase - 1)
+	counts = np.bincount(bins, minlength=nphase)
+	filled = np.flatnonzero(counts)
+	phase = (np.arange(nphase) + 0.5)/nphase
+	template = np.empty((3, nphase))
+	for row, values in enumerate([y, np.log10(R), np.asarray(T, dtype=float)]):
+		sums = np.bincount(bins, weights=values[rows], minlength=nphase)
+		template[row] = np.interp(phase, phase[filled], sums[filled]/counts[filled], period=1)
+
+	shift = -np.angle(np.sum(template[0]*np.exp(-2j*np.pi*phase)))/(2*np.pi)
+	template = np.array([np.interp(phase + shift, phase, values, period=1) for values in template])
+	return period, template
+
+#interpolator of normalised Cepheid light curves over a library of MESA runs
+#the runs are placed at (log M, log L, log Teff, X, Z), scaled to unit variance and projected onto the directions the library actually spans, so a library that only varies some of the parameters still interpolates
+#log period and the templates of curve_template are interpolated linearly between the runs (in a Delaunay triangulation, or along a line for a one-parameter library); stars outside the library take the nearest run and are flagged as extrapolated
+class CepheidGrid:
+	def __init__(self, params, periods, templates):
+		self.params = np.asarray(params, dtype=float)
+		self.periods = np.asarray(periods, dtype=float)
+		self.templates = np.asarray(templates, dtype=float)
+		self.nphase = self.templates.shape[-1]
+
+		x = self.coordinates(self.params, scale=False)
+		self.center = x.mean(axis=0)
+		self.scale = x.std(axis=0)
+		self.scale[np.ptp(x, axis=0) == 0] = 1.
+		x = (x - self.center)/self.scale
+		u, s, vt = np.linalg.svd(x, full_matrices=False)
+		self.basis = vt[s > 1e-8*max(s.max(), 1e-300)]
+
+		values = np.hstack([np.log10(self.periods)[:, None], self.templates.reshape(len(self.periods), -1)])
+		points = x @ self.basis.T
+		if len(self.basis) == 0:
+			self.interpolator = None
+			self.values = values
+		elif len(self.basis) == 1:
+			order = np.argsort(points[:, 0])
+			self.points, self.values = points[order, 0], values[order]
+		else:
+			from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
+			self.interpolator = LinearNDInterpolator(points, values)
+			self.nearest = NearestNDInterpolator(points, values)
+
+	#builds the grid from the runs listed by library_index (a table, run directories or glob patterns), reading each history through rotsesim.mesa
+	@classmethod
+	def from_library(cls, library, columns=default_columns, ncycles=10, nphase=256, verbose=False):
+		index = library_index(library)
+		params, periods, templates = [], [], []
+		for i, run in index.iterrows():
+			history = read_history(run["history"], list(columns))
+			try:
+				period, template = curve_template(*(np.asarray(history[name], dtype=float) for name in columns), ncycles=ncycles, nphase=nphase)
+			except ValueError as error:
+				print("Skipped {}: {}".format(run["history"], error))
+				continue
+			params.append([run[name] for name in grid_params])
+			periods.append(period)
+			templates.append(template)
+			if verbose:
+				print("{}: period = {:0.4f} days".format(run["history"], period))
+		if len(params) == 0:
+			raise ValueError("no usable runs in the library")
+		return cls(params, periods, templates)
+
+	def save(self, filename):
+		np.savez(filename, params=self.params, periods=self.periods, templates=self.templates)
+
+	@classmethod
+	def load(cls, filename):
+		grid = np.load(filename)
+		return cls(grid["params"], grid["periods"], grid["templates"])
+
+	#(n, 5) array of the five parameters of a table of stars (as sampled by Ceph_init_params.sample_cepheids) or array, mapped to the interpolation coordinates
+	def coordinates(self, stars, scale=True):
+		if hasattr(stars, "columns"):
+			stars = stars[list(grid_params)].to_numpy()
+		x = np.atleast_2d(np.asarray(stars, dtype=float)).copy()
+		x[:, :3] = np.log10(x[:, :3])
+		if scale:
+			x = (x - self.center)/self.scale
+		return x
+
+	#interpolated periods (n,), templates (n, 3, nphase) and extrapolation flags (n,) of a table of stars
+	#stars off the directions the library spans (e.g. another mass when the library only varies L) are flagged as extrapolated too
+	def interpolate(self, stars):
+		z = self.coordinates(stars)
+		x = z @ self.basis.T
+		offgrid = np.linalg.norm(z - x @ self.basis, axis=1) > 1e-6
+		if len(self.basis) == 0:
+			values = np.repeat(self.values, len(x), axis=0)
+			outside = offgrid
+		elif len(self.basis) == 1:
+			values = np.stack([np.interp(x[:, 0], self.points, column) for column in self.values.T], axis=1)
+			outside = (x[:, 0] < self.points[0]) | (x[:, 0] > self.points[-1])
+		else:
+			values = self.interpolator(x)
+			outside = np.isnan(values[:, 0])
+			if outside.any():
+				values[outside] = self.nearest(x[outside])
+				#runs on the edge of the library can fall just outside the triangulation, but their nearest run is exact
+				outside[outside] = self.nearest.tree.query(x[outside])[0] > 1e-8
+		return 10**values[:, 0], values[:, 1:].reshape(len(x), 3, self.nphase), outside | offgrid
+
+	#light curves of a table of stars at the times (days) given, as (n, len(times)) arrays of luminosity, radius and Teff in the units of the library histories
+	#each star starts at a random phase drawn from a seedable Generator unless phase is given
+	def light_curves(self, stars, times, phase=None, seed=None):
+		periods, templates, outside = self.interpolate(stars)
+		if phase is None:
+			phase = np.random.default_rng(seed).random(len(periods))
+		position = ((np.asarray(times, dtype=float)[None, :]/periods[:, None] + np.asarray(phase)[..., None]) % 1)*self.nphase - 0.5
+		i = np.floor(position).astype(int)
+		w = position - i
+		i, j = i % self.nphase, (i + 1) % self.nphase
+		curves = []
+		for row in range(3):
+			template = templates[:, row]
+			curves.append(np.take_along_axis(template, i, axis=1)*(1 - w) + np.take_along_axis(template, j, axis=1)*w)
+		return {"luminosity": 10**curves[0], "Rstar": 10**curves[1], "Teff": curves[2], "period": periods, "extrapolated": outside}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--library", nargs='+', required=True) #csv table of runs, rsp_Cepheid run directories (or glob patterns), or a grid saved with --save
+	parser.add_argument("--columns", nargs=4, default=list(default_columns)) #history columns of the time, luminosity, radius and effective temperature
+	parser.add_argument("--ncycles", type=int, default=10) #number of final pulsation cycles averaged into each template
+	parser.add_argument("--nphase", type=int, default=256) #number of phases in each template
+	parser.add_argument("--save", default=None) #save the grid built from the library to this .npz file for later runs
+	parser.add_argument("--population", default=None) #csv table of stars written by Ceph_init_params.py --output
+	parser.add_argument("--n", type=int, default=None) #otherwise sample this many stars with Ceph_init_params.sample_cepheids
+	parser.add_argument("--lrange", type=float, nargs=2, default=[500., 45000.]) #range of luminosities to sample from
+	parser.add_argument("--seed", type=int, default=None) #random seed for the sampled stars and their phases
+	parser.add_argument("--days", type=float, default=100.) #length of each light curve in days
+	parser.add_argument("--step", type=float, default=0.1) #time step of each light curve in days
+	parser.add_argument("--chunk", type=int, default=1000) #number of stars emulated at a time
+	parser.add_argument("--outdir", default="emulated") #directory to write one csv light curve per star to, and stars.csv with the parameters and period of every star
+	args = parser.parse_args()
+
+	import pandas as pd
+
+	if len(args.library) == 1 and args.library[0].endswith(".npz"):
+		grid = CepheidGrid.load(args.library[0])
+	else:
+		library = args.library[0] if len(args.library) == 1 and os.path.isfile(args.library[0]) else args.library
+		grid = CepheidGrid.from_library(library, args.columns, args.ncycles, args.nphase, verbose=True)
+	if args.save is not None:
+		grid.save(args.save)
+
+	if args.population is not None:
+		stars = pd.read_csv(args.population, index_col=0)
+	elif args.n is not None:
+		from rotsesim.cepheid.Ceph_init_params import sample_cepheids
+		stars = sample_cepheids(n=args.n, lrange=args.lrange, seed=args.seed)
+	else:
+		stars = None
+
+	if stars is not None:
+		os.makedirs(args.outdir, exist_ok=True)
+		times = np.arange(0, args.days, args.step)
+		rng = np.random.default_rng(args.seed)
+		stars = stars.assign(period=np.nan, extrapolated=False)
+		for start in range(0, len(stars), args.chunk):
+			block = stars.iloc[start:start + args.chunk]
+			curves = grid.light_curves(block, times, phase=rng.random(len(block)))
+			stars.loc[block.index, "period"] = curves["period"]
+			stars.loc[block.index, "extrapolated"] = curves["extrapolated"]
+			for row, star in enumerate(block.index):
+				curve = pd.DataFrame({"star_age_day": times, "luminosity": curves["luminosity"][row], "Rstar": curves["Rstar"][row], "Teff": curves["Teff"][row]})
+				curve.to_csv(os.path.join(args.outdir, "star{}.csv".format(star)), index=False, columns=list(curve_columns))
+		stars.to_csv(os.path.join(args.outdir, "stars.csv"), index_label="star")
+		print("Emulated {} stars, {} outside the library".format(len(stars), int(stars["extrapolated"].sum())))
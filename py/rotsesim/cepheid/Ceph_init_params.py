@@ -1,46 +1,116 @@
-import numpy as np
-import matplotlib.pyplot as plt
+import argparse
 import os
-import csv
-import scipy.integrate as integrate
-import scipy.special as special
-import random
 
-L = float(input("Enter luminosity of star in solar luminosity units (Suggested values are between 500-45000): "))
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr, ndtri
+
+R_sol = float(696340000) #radius of sun in meters
+
+sigma = 5.670374419*10**-8 #Joules*meters**-2*s**-1*K**-4
 
-Y = float((random.randint(25, 31))/100)
+L_sol = 3.827*10**26 #luminosity of the sun in watts
 
-Z = float(np.random.normal(0.02, 0.005)) #AAW 04.12.20; made Z = variable number whose mean is 0.02 and std of 0.005, rather than a fixed value of Z = 0.02
+#number of random numbers each star needs: Y, Z, the two coefficients of the radius relation, and its luminosity when it is drawn from a distribution
+ndraws = 5
 
-X = float(1 - (Y + Z))
+#draws an (n, ndraws) array of uniform numbers in [0, 1) from a seedable Generator, or from a scrambled Sobol sequence for quasi-random sampling (best with n a power of 2)
+def uniform_draws(n, seed=None, sobol=False):
+	rng = np.random.default_rng(seed)
+	if sobol:
+		from scipy.stats import qmc
+		return qmc.Sobol(ndraws, scramble=True, seed=rng).random(n)
+	return rng.random((n, ndraws))
 
-# original M-L relationship: L = float(10**(0.72 + 3.35*np.log10(M) + 1.36*np.log10(Y/0.28) - 0.34*np.log(Z/0.02)))
+#evaluates the initial parameters of a Cepheid for every luminosity L (in solar units) at once, turning the uniform numbers u from uniform_draws into the random quantities:
+#Y is one of 0.25, 0.26, ..., 0.31 with equal probability
+#Z is normal with mean 0.02 and std 0.005 (AAW 04.12.20), truncated at Z > 0 so that log10(Z/0.02) is always defined
+#the two coefficients of the radius relation are normal with means 0.09 and 0.48 and std 0.03
+#returns a table with one row per star and the MESA rsp_Cepheid inlist parameters as columns, plus Y and R (in meters)
+def cepheid_params(L, u):
+	L = np.asarray(L, dtype=float)
 
-M = float(10**((1/3.35)*(np.log10(L) - 0.72 - 1.36*np.log10(Y/0.28) + 0.34*np.log10(Z/0.02)))) #citation [1]
+	Y = (25 + np.minimum(np.floor(7*u[:, 0]), 6))/100
 
-#original data: Teff_theoretical = float(-0.047135*L + 5915.741956)
-# original data: sigma = 449.98
+	Zlow = ndtr(-0.02/0.005)
+	Z = 0.02 + 0.005*ndtri(Zlow + (1 - Zlow)*u[:, 1])
 
-R_sol = float(696340000) #radius of sun in meters
+	X = 1 - (Y + Z)
 
-R = R_sol*10**( (np.log10(M) + (np.random.normal(0.09, 0.03))) / (np.random.normal(0.48, 0.03)) ) #citation [2]
+	# original M-L relationship: L = float(10**(0.72 + 3.35*np.log10(M) + 1.36*np.log10(Y/0.28) - 0.34*np.log(Z/0.02)))
 
-sigma = 5.670374419*10**-8 #Joules*meters**-2*s**-1*K**-4
+	M = 10**((1/3.35)*(np.log10(L) - 0.72 - 1.36*np.log10(Y/0.28) + 0.34*np.log10(Z/0.02))) #citation [1]
 
-L_sol = 3.827*10**26 #luminosity of the sun in watts
-L_star = L*L_sol
+	#original data: Teff_theoretical = float(-0.047135*L + 5915.741956)
+	# original data: sigma = 449.98
+
+	R = R_sol*10**( (np.log10(M) + (0.09 + 0.03*ndtri(u[:, 2]))) / (0.48 + 0.03*ndtri(u[:, 3])) ) #citation [2]
+
+	L_star = L*L_sol
+
+	Teff_actual = (L_star/(sigma*4*np.pi*R**2))**0.25
+
+	#Teff_theoretical = float(-0.052*L + 6500)
+	#sigma = 300
+	#Teff_actual = float(np.random.normal(Teff_theoretical, sigma))
+
+	return pd.DataFrame({"RSP_mass": M, "RSP_L": L, "RSP_Teff": Teff_actual, "RSP_X": X, "RSP_Z": Z, "Y": Y, "R": R})
+
+#samples a population of Cepheids in one vectorized pass
+#L gives the luminosity of every star (a single value, a grid, or values drawn elsewhere); otherwise n luminosities are drawn log-uniformly from lrange
+#seed seeds the Generator, so the same seed always gives the same population; sobol=True uses a scrambled Sobol sequence instead of pseudo-random numbers
+def sample_cepheids(L=None, n=None, lrange=(500., 45000.), seed=None, sobol=False):
+	if L is not None:
+		L = np.atleast_1d(np.asarray(L, dtype=float))
+		if n is not None and len(L) == 1:
+			L = np.repeat(L, n)
+		n = len(L)
+	u = uniform_draws(n, seed, sobol)
+	if L is None:
+		L = 10**(np.log10(lrange[0]) + (np.log10(lrange[1]) - np.log10(lrange[0]))*u[:, 4])
+	return cepheid_params(L, u)
+
+#formats one star of a sampled table as the lines of the &controls section of inlist_rsp_Cepheid
+def inlist_text(star):
+	return "".join("      {} = {:.6f}d0\n".format(name, star[name]) for name in ["RSP_mass", "RSP_Teff", "RSP_L", "RSP_X", "RSP_Z"])
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--L", type=float, nargs='+', default=None) #luminosities of the stars in solar luminosity units
+	parser.add_argument("--n", type=int, default=None) #number of stars; luminosities are drawn log-uniformly from --lrange unless --L is given
+	parser.add_argument("--lrange", type=float, nargs=2, default=[500., 45000.]) #range of luminosities to draw from
+	parser.add_argument("--grid", type=int, default=None) #instead use this many luminosities evenly spaced in log L across --lrange
+	parser.add_argument("--seed", type=int, default=None) #random seed for a reproducible population
+	parser.add_argument("--sobol", action='store_true', default=False) #quasi-random Sobol sampling
+	parser.add_argument("--output", default=None) #csv file to write the table of stars to
+	parser.add_argument("--inlists", default=None) #directory to write one file of inlist parameters per star to
+	args = parser.parse_args()
+
+	L = args.L
+	if args.grid is not None:
+		L = np.logspace(np.log10(args.lrange[0]), np.log10(args.lrange[1]), args.grid)
 
-Teff_actual = float( (L_star/(sigma*4*np.pi*R**2))**0.25 )
+	#without any luminosities, ask for one star's luminosity as before
+	if L is None and args.n is None:
+		L = float(input("Enter luminosity of star in solar luminosity units (Suggested values are between 500-45000): "))
 
-#Teff_theoretical = float(-0.052*L + 6500)
-#sigma = 300
-#Teff_actual = float(np.random.normal(Teff_theoretical, sigma))
+	stars = sample_cepheids(L, args.n, args.lrange, args.seed, args.sobol)
 
-print( "M =", M )
-print("L =", L )
-print( "T_eff =", Teff_actual ) 
-print( "X =", X )
-print( "Z =", Z )
+	if args.output is not None:
+		stars.to_csv(args.output, index_label="star")
+	if args.inlists is not None:
+		os.makedirs(args.inlists, exist_ok=True)
+		for i, star in stars.iterrows():
+			with open(os.path.join(args.inlists, "inlist_star{}".format(i)), "w") as f:
+				f.write(inlist_text(star))
+	if args.output is None and args.inlists is None:
+		for i, star in stars.iterrows():
+			print( "M =", star["RSP_mass"] )
+			print("L =", star["RSP_L"] )
+			print( "T_eff =", star["RSP_Teff"] )
+			print( "X =", star["RSP_X"] )
+			print( "Z =", star["RSP_Z"] )
 
 #[1]- Caputo et al. “Pulsation and evolutionary masses of classical Cepheids. I. Milky Way variables.” arXiv:astro-ph/0505149
 #[2]- Bono et al. “Improving the mass determination of Galactic Cepheids.” arXiv:astro-ph/0108271
@@ -1,30 +1,15 @@
 #these lines import various libraries to use
-import numpy as np
-import matplotlib.pyplot as plt
-import math
+import argparse
+import glob
+import hashlib
+import json
 import os
-import csv
-import random
-import itertools
-
-import pandas as pd
-
-from astropy.io import fits
-from astropy.table import Table, join
-from astropy.io.ascii import write, read
-from scipy.optimize import curve_fit, leastsq
-from scipy.stats import chisquare
-from scipy.stats import norm, cauchy, chisquare
-
-inputcsv = pd.read_csv('C4.1_period730.csv') #tells the script which csv file to use as a source of input data; the csv file must be in the same directory as this script
-
-Rstar = inputcsv['Rstar'] #identifies the column for the Radius of the star
-
-
-Teff = inputcsv['Teff'] #identifies the column for the T_effective of the star
-
-star_age = inputcsv['star_age_day'] #identifies the column for the time of each input data point
+import sqlite3
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 
 h = 6.626*10**-34  #Planck's constant in J s
 
@@ -52,31 +37,388 @@ def Phot(l, R, T):
 	return P
 
 
-#creates an output text file called output1.txt where the first column is the radius of the star, the second column is the effective temperature of the star, and the third column is the number of photons/second in each wavelength of light, starting at 299 nm and ending at 1001 nm
-#this means that for each pair of Rstar and Teff, there will be around 700 values of photons
-file=open("output1.txt", "a")
+#integer wavelengths from 299 nm to 1000 nm (in meters) at which the photons are counted
+wavelengths = np.arange(299, 1001)*10**-9
+
+#evaluates Phot for every row of R and T at every wavelength as one (rows, wavelengths) array, chunk rows at a time so memory stays bounded
+#yields the slice of rows, the spectrum of those rows and their total number of photons/second summed over all wavelengths
+#with a SpectrumCache, the spectra come from the cache (computed only for temperatures it does not hold yet) scaled by R**2
+def phot_spectrum(R, T, l=wavelengths, chunk=10000, cache=None):
+	R = np.asarray(R, dtype=float)
+	T = np.asarray(T, dtype=float)
+	for start in range(0, len(R), chunk):
+		rows = slice(start, min(start + chunk, len(R)))
+		if cache is None:
+			spectrum = Phot(l[None, :], R[rows, None], T[rows, None])
+		else:
+			spectrum = R[rows, None]**2*cache.unit_spectra(T[rows])
+		yield rows, spectrum, spectrum.sum(axis=1)
+
+
+#writes the spectrum and a row table to a compressed NumPy .npz file, streaming the spectrum into the file one block of rows at a time
+#the file holds the (rows, wavelengths) array spectrum, the wavelength array (in meters) and the row table columns Rstar, Teff and total (photons/second summed over all wavelengths)
+#spectra can be stored as float32 to halve the file size; the totals are always summed in float64
+#deflate (at its fastest level) only shrinks float spectra by a few percent, so compress=False stores them uncompressed for the fastest writes
+#with text=True the legacy output1.txt and output2.txt files are also written from the same evaluation, replacing any earlier files
+#the time of each row (star_age_day) is stored too when given
+#with a response matrix (see response_matrix), the response-weighted photons/second of every row for every curve are stored as rates, with the curve names as bands
+def write_spectra(filename, R, T, l=wavelengths, chunk=10000, dtype=np.float64, compress=True, text=False, response=None, bands=None, time=None, cache=None):
+	R_in = np.asarray(R)
+	T_in = np.asarray(T)
+	totals = np.empty(len(R_in))
+	arrays = [("wavelength", l), ("Rstar", R_in.astype(float)), ("Teff", T_in.astype(float)), ("total", totals)]
+	if time is not None:
+		arrays.append(("star_age_day", np.asarray(time, dtype=float)))
+	if response is not None:
+		rates = np.empty((len(R_in), response.shape[1]))
+		arrays += [("rates", rates), ("bands", np.array(bands if bands is not None else [str(i) for i in range(response.shape[1])]))]
+	if text:
+		file1 = open("output1.txt", "w")
+		file2 = open("output2.txt", "w")
+
+	with zipfile.ZipFile(filename, "w", compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED, compresslevel=1) as archive:
+		with archive.open("spectrum.npy", "w", force_zip64=True) as f:
+			np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": (len(R_in), len(l))})
+			for rows, spectrum, total in phot_spectrum(R_in, T_in, l, chunk, cache):
+				f.write(spectrum.astype(dtype, copy=False).tobytes())
+				totals[rows] = total
+				if response is not None:
+					rates[rows] = spectrum @ response
+				if text:
+					write_text(file1, file2, R_in[rows], T_in[rows], spectrum, total)
+		for name, array in arrays:
+			with archive.open(name + ".npy", "w") as f:
+				np.lib.format.write_array(f, np.asarray(array))
 
-for a, b in zip(Rstar, Teff):
-	for i in range(299, 1001):
-		photon_in_each_lambda = str(Phot(i*10**-9, a, b))
+	if text:
+		file1.close()
+		file2.close()
+	return totals
+
+#writes one block of rows in the legacy text format: output1.txt gets a line of Rstar, Teff and photons/second for every wavelength of every row, output2.txt a line of Rstar, Teff and the total for every row
+def write_text(file1, file2, R, T, spectrum, total):
+	for a, b, photons, photons_sum in zip(R.tolist(), T.tolist(), spectrum.tolist(), total.tolist()):
 		a_str = str(a)
 		b_str = str(b)
-		file.write(a_str + "\t" + b_str + "\t" + photon_in_each_lambda + "\n")
+		file1.write("".join(a_str + "\t" + b_str + "\t" + str(photon_in_each_lambda) + "\n" for photon_in_each_lambda in photons))
+		file2.write(a_str + "\t" + b_str + "\t" + str(photons_sum) + "\n")
+
+#reads a tabulated response curve (any table astropy can read, e.g. .ecsv, .fits or .csv) and returns its wavelengths in meters and its response values
+#the first two columns are used unless wavecol and respcol name others; wavelengths are converted from the unit of the column, or from unit (default nm) if it has none
+def read_response(filename, wavecol=None, respcol=None, unit="nm"):
+	from astropy.table import Table
+	import astropy.units as u
+
+	table = Table.read(filename)
+	column = table[wavecol if wavecol is not None else table.colnames[0]]
+	if column.unit is not None:
+		wave = column.quantity.to_value(u.m)
+	else:
+		wave = (np.asarray(column, dtype=float)*u.Unit(unit)).to_value(u.m)
+	resp = np.asarray(table[respcol if respcol is not None else table.colnames[1]], dtype=float)
+	order = np.argsort(wave)
+	return wave[order], resp[order]
+
+#builds the (wavelengths, curves) response matrix from a list of (wavelength, response) curves, each linearly interpolated onto the wavelengths l and zero outside its tabulated range
+def response_matrix(curves, l=wavelengths):
+	return np.stack([np.interp(l, wave, resp, left=0., right=0.) for wave, resp in curves], axis=1)
+
+#response-weighted photons/second of every (R, T) row for every curve of the response matrix, from one matrix product of each block of the spectrum with the matrix
+def band_rates(R, T, response, l=wavelengths, chunk=10000, cache=None):
+	rates = np.empty((len(R), response.shape[1]))
+	for rows, spectrum, total in phot_spectrum(R, T, l, chunk, cache):
+		rates[rows] = spectrum @ response
+	return rates
+
+#reads a file written by write_spectra into a dictionary of arrays
+def read_spectra(filename):
+	with np.load(filename) as data:
+		return {name: data[name] for name in data.files}
+
+#directory where the Teff lookup tables are cached between runs
+table_cache = os.path.join(os.path.expanduser("~"), ".cache", "rotsesim")
+
+#band-integrated photons/second of a star of unit radius at each temperature T, i.e. the direct sum of Phot over all wavelengths l
+#the total of a star of radius R is R**2 times this, since Phot depends on R only through R**2
+def band_rate(T, l=wavelengths):
+	T = np.asarray(T, dtype=float)
+	return Phot(l[None, :], 1., T[:, None]).sum(axis=1)
+
+#builds, or loads from the cache directory, a cubic spline of log(band_rate) against log(Teff) on n log-spaced temperatures from Tmin to Tmax
+#the cache file is keyed by the wavelengths, dlt_lambda, the other constants of Phot and the temperature grid, so changing any of them builds a new table
+#the maximum relative error of the spline against the direct sum is measured at the midpoints of the grid when the table is built
+#returns the spline, its temperature range and the maximum relative error
+def teff_table(l=wavelengths, Tmin=1000., Tmax=50000., n=2000, cachedir=table_cache):
+	from scipy.interpolate import CubicSpline
+
+	key = json.dumps({"lmin": l[0], "lmax": l[-1], "nl": len(l), "dlt_lambda": dlt_lambda, "h": h, "c": c, "k": k, "D": D, "A_CCD": A_CCD,
+		"Tmin": Tmin, "Tmax": Tmax, "n": n}, sort_keys=True)
+	filename = os.path.join(cachedir, "teff_table_" + hashlib.sha1((key + hashlib.sha1(l.tobytes()).hexdigest()).encode()).hexdigest()[:16] + ".npz")
+	if os.path.exists(filename):
+		with np.load(filename) as table:
+			logT, lograte, maxerr = table["logT"], table["lograte"], float(table["maxerr"])
+		spline = CubicSpline(logT, lograte, extrapolate=False)
+	else:
+		logT = np.linspace(np.log(Tmin), np.log(Tmax), n)
+		lograte = np.log(band_rate(np.exp(logT), l))
+		spline = CubicSpline(logT, lograte, extrapolate=False)
+		midT = 0.5*(logT[1:] + logT[:-1])
+		maxerr = np.max(np.abs(np.exp(spline(midT))/band_rate(np.exp(midT), l) - 1))
+		os.makedirs(cachedir, exist_ok=True)
+		tmpfile = filename + ".tmp{}.npz".format(os.getpid())
+		np.savez(tmpfile, logT=logT, lograte=lograte, maxerr=maxerr, key=key)
+		os.replace(tmpfile, filename)
+	return spline, (Tmin, Tmax), maxerr
+
+#total photons/second of every (R, T) row from the Teff lookup table: an interpolation plus R**2 scaling instead of a sum over every wavelength
+def phot_totals(R, T, table=None):
+	if table is None:
+		table = teff_table()
+	spline, (Tmin, Tmax), maxerr = table
+	R = np.asarray(R, dtype=float)
+	T = np.asarray(T, dtype=float)
+	if np.any(T < Tmin) or np.any(T > Tmax):
+		raise ValueError("Teff outside the lookup table range {} to {} K".format(Tmin, Tmax))
+	return R**2*np.exp(spline(np.log(T)))
+
+#default location of the spectrum cache
+spectrum_cache = os.path.join(table_cache, "spectra.sqlite")
+
+#persistent cache of spectra in an sqlite file, shared by every run
+#a spectrum depends on R only through R**2, so the cache holds spectra of unit radius keyed by Teff quantized to tquant (K) together with a hash of the wavelengths, dlt_lambda, D, A_CCD and the other constants of Phot
+#repeated temperatures within a block of rows are computed or looked up once; spectra found in the cache count as hits and computed ones as misses
+#the cache is kept below maxbytes of spectra by evicting the least recently used ones
+#spectra are evaluated at the quantized temperatures, so they differ from the direct Phot values by a relative error of order (h*c/(k*T*l))*tquant/T, a few 1e-6 for tquant = 0.01 K
+class SpectrumCache:
+	def __init__(self, filename=spectrum_cache, l=wavelengths, maxbytes=2**30, tquant=0.01):
+		self.filename = filename
+		self.l = l
+		self.maxbytes = maxbytes
+		self.tquant = tquant
+		self.hits = 0
+		self.misses = 0
+		self.rows = 0
+		self.temperatures = set() #quantized temperatures seen, as the hits and misses count them once per block of rows
+		key = json.dumps({"dlt_lambda": dlt_lambda, "h": h, "c": c, "k": k, "D": D, "A_CCD": A_CCD, "tquant": tquant}, sort_keys=True)
+		self.prefix = hashlib.sha1(key.encode() + np.ascontiguousarray(l).tobytes()).hexdigest()[:16]
+		self._db = None
+
+	#the sqlite connection is opened lazily and not pickled, so a cache can be handed to worker processes
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		state["_db"] = None
+		return state
+
+	@property
+	def db(self):
+		if self._db is None:
+			os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+			self._db = sqlite3.connect(self.filename, timeout=60)
+			self._db.execute("CREATE TABLE IF NOT EXISTS spectra (key TEXT PRIMARY KEY, spectrum BLOB, used REAL)")
+			self._db.execute("CREATE INDEX IF NOT EXISTS spectra_used ON spectra (used)")
+		return self._db
+
+	#spectra of unit radius at every temperature T, as a (len(T), wavelengths) array
+	def unit_spectra(self, T):
+		q = np.round(np.asarray(T, dtype=float)/self.tquant).astype(np.int64)
+		states, inverse = np.unique(q, return_inverse=True)
+		keys = ["{}:{}".format(self.prefix, state) for state in states.tolist()]
+		spectra = np.empty((len(states), len(self.l)))
+		found = np.zeros(len(states), dtype=bool)
+		index = {key: i for i, key in enumerate(keys)}
+		for start in range(0, len(keys), 500):
+			batch = keys[start:start + 500]
+			for key, blob in self.db.execute("SELECT key, spectrum FROM spectra WHERE key IN ({})".format(",".join("?"*len(batch))), batch):
+				spectra[index[key]] = np.frombuffer(blob, dtype=np.float64)
+				found[index[key]] = True
+
+		missing = np.flatnonzero(~found)
+		if len(missing) > 0:
+			spectra[missing] = Phot(self.l[None, :], 1., states[missing, None]*self.tquant)
+		now = time.time()
+		with self.db:
+			self.db.executemany("UPDATE spectra SET used = ? WHERE key = ?", [(now, keys[i]) for i in np.flatnonzero(found)])
+			self.db.executemany("INSERT OR REPLACE INTO spectra VALUES (?, ?, ?)", [(keys[i], spectra[i].tobytes(), now) for i in missing])
+		self.hits += int(found.sum())
+		self.misses += len(missing)
+		self.rows += len(q)
+		self.temperatures.update(states.tolist())
+		if len(missing) > 0:
+			self.evict()
+		return spectra[inverse]
+
+	#removes the least recently used spectra until the cache holds at most maxbytes of spectra
+	def evict(self):
+		nbytes = len(self.l)*8
+		count = self.db.execute("SELECT COUNT(*) FROM spectra").fetchone()[0]
+		excess = count - self.maxbytes//nbytes
+		if excess > 0:
+			with self.db:
+				self.db.execute("DELETE FROM spectra WHERE key IN (SELECT key FROM spectra ORDER BY used LIMIT ?)", (excess,))
+
+	def report(self):
+		return "Spectrum cache: {} rows, {} distinct temperatures, {} hits, {} misses".format(self.rows, len(self.temperatures), self.hits, self.misses)
+
+#MESA history columns holding the radius, the effective temperature and the time of each row
+default_columns = ("Rstar", "Teff", "star_age_day")
+
+#reads the radius, effective temperature and time columns of one MESA output (a csv file or history.data) and writes its photons/second to output
+#only the needed columns are read, and they are cached so later runs on the same file load instantly
+#with totals=True, only the row table is written, with totals interpolated from the Teff lookup table; otherwise the whole spectrum is written with write_spectra
+#with a response matrix, the photons/second weighted by each response curve are also written, as rates with one column per curve
+#with a SpectrumCache the spectra are served from the cache; returns the output name and the cache hits and misses of this star
+def process_star(filename, output, columns=default_columns, totals=False, response=None, bands=None, chunk=10000, dtype=np.float64, compress=True, text=False, cache=None):
+	from rotsesim.mesa import read_history
+	inputcsv = read_history(filename, list(columns))
+
+	Rstar = inputcsv[columns[0]] #identifies the column for the Radius of the star
+
+	Teff = inputcsv[columns[1]] #identifies the column for the T_effective of the star
+
+	star_age = inputcsv[columns[2]] #identifies the column for the time of each input data point
+
+	if totals:
+		arrays = {"wavelength": wavelengths, "Rstar": np.asarray(Rstar, dtype=float), "Teff": np.asarray(Teff, dtype=float), "total": phot_totals(Rstar, Teff), "star_age_day": np.asarray(star_age, dtype=float)}
+		if response is not None:
+			arrays.update(rates=band_rates(Rstar, Teff, response, chunk=chunk, cache=cache), bands=np.array(bands))
+		np.savez_compressed(output, **arrays)
+	else:
+		write_spectra(output, Rstar, Teff, chunk=chunk, dtype=dtype, compress=compress, text=text, response=response, bands=bands, time=star_age, cache=cache)
+	if cache is None:
+		return output, 0, 0
+	return output, cache.hits, cache.misses
+
+#reads the radius, effective temperature and time columns of one MESA output and returns its photons/second in memory, without writing any file
+#returns a pandas table with the columns star_age_day, Rstar, Teff and photon_rate, the photons/second reaching the ROTSE-III CCD in each row
+#photon_rate is the total over all wavelengths from the Teff lookup table, or with a response matrix the rate weighted by its first curve
+def photon_rates(filename, columns=default_columns, response=None, chunk=10000, cache=None):
+	import pandas as pd
+	from rotsesim.mesa import read_history
+	history = read_history(filename, list(columns))
+	Rstar = np.asarray(history[columns[0]], dtype=float)
+	Teff = np.asarray(history[columns[1]], dtype=float)
+	if response is None:
+		rate = phot_totals(Rstar, Teff)
+	else:
+		rate = band_rates(Rstar, Teff, response[:, :1], chunk=chunk, cache=cache)[:, 0]
+	return pd.DataFrame({"star_age_day": np.asarray(history[columns[2]], dtype=float), "Rstar": Rstar, "Teff": Teff, "photon_rate": rate})
+
+#expands files, directories (every file directly inside them) and glob patterns into a sorted list of MESA outputs
+def batch_inputs(paths):
+	inputs = set()
+	for path in paths:
+		if os.path.isdir(path):
+			inputs.update(os.path.join(path, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name)))
+		else:
+			inputs.update(name for name in glob.glob(path) if os.path.isfile(name))
+	return sorted(os.path.abspath(name) for name in inputs)
+
+#output shard name of every input: the last three parts of its path (e.g. star1__LOGS__history.data) and a hash of its absolute path
+#the name depends only on the input itself, so adding inputs from other directories never renames the shards of a finished batch
+def shard_names(inputs):
+	names = []
+	for name in inputs:
+		name = os.path.abspath(name)
+		parts = [part for part in name.split(os.sep) if part][-3:]
+		names.append("__".join(parts) + "." + hashlib.sha1(name.encode()).hexdigest()[:8] + ".npz")
+	return names
+
+#processes many MESA outputs across a process pool, writing each star to its own shard in outdir
+#outdir/manifest.json lists every completed star with the size and modification time of its input and the settings used, and is updated as each star finishes
+#a rerun skips the stars whose input and settings are unchanged, so only new or changed inputs (or ones that failed) are processed
+#returns the manifest
+def run_batch(paths, outdir, workers=1, columns=default_columns, totals=False, response=None, bands=None, chunk=10000, dtype=np.float64, compress=True, cache=None):
+	inputs = batch_inputs(paths)
+	if not inputs:
+		raise ValueError("No MESA outputs found in {}".format(paths))
+	settings = {"columns": list(columns), "totals": totals, "dtype": np.dtype(dtype).str, "compress": compress,
+		"response": None if response is None else hashlib.sha1(np.ascontiguousarray(response).tobytes()).hexdigest(), "bands": bands}
+
+	os.makedirs(outdir, exist_ok=True)
+	manifestfile = os.path.join(outdir, "manifest.json")
+	manifest = {"stars": {}}
+	if os.path.exists(manifestfile):
+		with open(manifestfile) as f:
+			manifest = json.load(f)
+
+	todo = []
+	for filename, shard in zip(inputs, shard_names(inputs)):
+		stat = os.stat(filename)
+		entry = {"output": shard, "size": stat.st_size, "mtime": stat.st_mtime, "settings": settings}
+		if manifest["stars"].get(filename) != entry or not os.path.exists(os.path.join(outdir, shard)):
+			todo.append((filename, entry))
+	print("{} stars, {} up to date, {} to process".format(len(inputs), len(inputs) - len(todo), len(todo)))
+
+	#builds the Teff lookup table once before the workers start using it
+	if totals:
+		teff_table()
+
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = {pool.submit(process_star, filename, os.path.join(outdir, entry["output"]), columns, totals, response, bands, chunk, dtype, compress, False, cache): (filename, entry) for filename, entry in todo}
+		hits = misses = 0
+		for future in as_completed(futures):
+			filename, entry = futures[future]
+			try:
+				output, starhits, starmisses = future.result()
+			except Exception as error:
+				print("Failed {}: {}".format(filename, error))
+				continue
+			hits += starhits
+			misses += starmisses
+			manifest["stars"][filename] = entry
+			tmpfile = manifestfile + ".tmp"
+			with open(tmpfile, "w") as f:
+				json.dump(manifest, f, indent=1)
+			os.replace(tmpfile, manifestfile)
+
+	if cache is not None:
+		print("Spectrum cache: {} hits, {} misses".format(hits, misses))
+	return manifest
+
+
 
-file.close()
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--input", default='C4.1_period730.csv') #csv file of MESA output to use as a source of input data
+	parser.add_argument("--output", default='photons.npz') #compressed file the spectrum and row table are written to
+	parser.add_argument("--text", action='store_true', default=False) #also write the legacy output1.txt and output2.txt text files
+	parser.add_argument("--float32", action='store_true', default=False) #store the spectrum in single precision
+	parser.add_argument("--nocompress", action='store_true', default=False) #store the spectrum uncompressed, which is much faster to write
+	parser.add_argument("--totals", action='store_true', default=False) #only compute the total photons/second of each row, from the cached Teff lookup table
+	parser.add_argument("--response", nargs='+', default=None) #tables of response curves (wavelength and response columns) to weight the photon counts with
+	parser.add_argument("--response-unit", default="nm") #unit of the response curve wavelengths when the tables do not give one
+	parser.add_argument("--columns", nargs=3, default=list(default_columns)) #names of the radius, effective temperature and time columns of the MESA output (e.g. radius effective_T star_age_day for history.data)
+	parser.add_argument("--batch", nargs='+', default=None) #directories, files or glob patterns of many MESA outputs to process, one output shard per star
+	parser.add_argument("--outdir", default="photons") #directory the shards and manifest.json of --batch are written to
+	parser.add_argument("--workers", type=int, default=None) #number of processes for --batch (default one per CPU)
+	parser.add_argument("--cache", nargs='?', const=spectrum_cache, default=None) #serve spectra from a persistent cache, by default in ~/.cache/rotsesim/spectra.sqlite
+	parser.add_argument("--cache-size", type=float, default=1024.) #maximum size of the spectrum cache in MB
+	parser.add_argument("--tquant", type=float, default=0.01) #temperature step (K) the cached spectra are quantized to
+	parser.add_argument("--chunk", type=int, default=10000) #number of rows evaluated and written at a time
+	args = parser.parse_args()
 
-#creates an output text file called output2.txt where the first column is the radius of the star, the second column is the effective temperature of the star, and the third column is the total number of photons/second emitted for each associated Rstar and Teff (i.e. it sums the 700 or so data points from each Rstar and Teff pair and stores them next to the associated Rstar and Teff from which they were generated
-file=open("output2.txt", "a")
+	#writes the number of photons/second in each wavelength of light from 299 nm to 1000 nm for every pair of Rstar and Teff, and their total over all wavelengths
+	#with --text, also creates output1.txt (Rstar, Teff and the photons/second at one wavelength on each line, around 700 lines for each pair) and output2.txt (Rstar, Teff and the total photons/second of each pair)
+	#with --response, the photons/second weighted by each response curve are also written, as rates with one column per curve
+	response = None
+	bands = None
+	if args.response is not None:
+		response = response_matrix([read_response(filename, unit=args.response_unit) for filename in args.response])
+		bands = [os.path.basename(filename) for filename in args.response]
 
-for a, b in zip(Rstar, Teff):
-	output_of_func = []
-	for i in range(299, 1001):
-		Phot_output = Phot(i*10**-9, a, b)
-		output_of_func.append(Phot_output)
-	Phot_sum = sum(output_of_func)
-	photons_sum_str = str(Phot_sum)
-	a_str = str(a)
-	b_str = str(b)
-	file.write(a_str + "\t" + b_str + "\t" + photons_sum_str + "\n")
-file.close()
+	#with --totals, only the row table is written, with totals interpolated from the Teff lookup table
+	if args.totals:
+		print("Teff lookup table maximum relative error against the direct sum: {:.2e}".format(teff_table()[2]))
 
+	dtype = np.float32 if args.float32 else np.float64
+	cache = None
+	if args.cache is not None:
+		cache = SpectrumCache(args.cache, maxbytes=int(args.cache_size*2**20), tquant=args.tquant)
+	if args.batch is not None:
+		if args.text:
+			parser.error("--text cannot be used with --batch")
+		run_batch(args.batch, args.outdir, workers=args.workers, columns=args.columns, totals=args.totals, response=response, bands=bands, chunk=args.chunk, dtype=dtype, compress=not args.nocompress, cache=cache)
+	else:
+		process_star(args.input, args.output, columns=args.columns, totals=args.totals, response=response, bands=bands, chunk=args.chunk, dtype=dtype, compress=not args.nocompress, text=args.text, cache=cache)
+		if cache is not None:
+			print(cache.report())
@@ -0,0 +1,162 @@
+"""
+rotsesim.cosmo.benchmark
+
+Time pecvel_sim over a matrix of ngal, nsim and iterations values, with
+the catalog generation, initial fit and refit stages timed separately,
+and store the results as JSON so runs from different releases can be
+compared. Plotting is never used.
+"""
+
+import itertools
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+from rotsesim.cosmo import galsim
+from rotsesim.cosmo.sweep import code_version
+
+#- Matrix used when no values are given
+bench_defaults = {'ngal': [10,100,1000], 'nsim': [1000,10000], 'iterations': [1,5]}
+
+def time_call(func,repeat):
+    """
+    Best wall clock time of repeat calls of func, and the result of the last call
+    """
+    best = np.inf
+    for i in range(repeat):
+        start  = time.perf_counter()
+        result = func()
+        best   = min(best,time.perf_counter() - start)
+    return best, result
+
+def peak_memory(func):
+    """
+    Peak memory in MB traced while running func, including NumPy arrays
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]/2.**20
+    finally:
+        tracemalloc.stop()
+
+def bench_case(ngal,nsim,iterations,h0=70.,distance=(5.,30.),disterr=(0.2,0.05),pecvel=300.,seed=0,method='batch',repeat=3):
+    """
+    Benchmark one point of the matrix
+
+    The stages of one block of nsim simulations are timed on their own (best of
+    repeat), then pecvel_sim is timed end to end and run once more under
+    tracemalloc for its peak memory.
+    """
+    #- Pass the entropy rather than the SeedSequence, whose spawn counter simulate_catalogs
+    #- advances, so every repeat and stage works on the same catalogs
+    entropy = np.random.SeedSequence(seed).entropy
+    tsim, catalogs = time_call(lambda: galsim.simulate_catalogs(h0,distance,disterr,pecvel,ngal,nsim,entropy),repeat)
+    dist, derr, vel = catalogs
+    tfit, fit = time_call(lambda: galsim.fit_h0_batch(dist,derr,vel,method=method),repeat)
+    trefit, refit = time_call(lambda: galsim.refit_h0(dist,derr,vel,fit[0],iterations,method=method),repeat)
+
+    run = lambda: galsim.pecvel_sim(h0,distance,disterr,pecvel,ngal,nsim,iterations,False,False,entropy,
+                                    method=method,blocksize=nsim,verbose=False)
+    ttotal, summary = time_call(run,repeat)
+
+    return {'ngal': ngal, 'nsim': nsim, 'iterations': iterations,
+            'simulate_s': tsim, 'initial_fit_s': tfit, 'refit_s': trefit, 'total_s': ttotal,
+            'sims_per_s': nsim/ttotal, 'refits': int(np.sum(refit[4])),
+            'peak_mb': peak_memory(run), 'h0mean': summary['h0mean'][-1]}
+
+def environment():
+    """
+    Description of the machine and code the benchmark ran on
+    """
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'code_version': code_version(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run_benchmark(ngal=None,nsim=None,iterations=None,method='batch',repeat=3,seed=0,verbose=True):
+    """
+    Benchmark every combination of the ngal, nsim and iterations values
+    """
+    matrix = {'ngal': ngal or bench_defaults['ngal'], 'nsim': nsim or bench_defaults['nsim'],
+              'iterations': iterations or bench_defaults['iterations']}
+    results = {'environment': environment(), 'method': method, 'repeat': repeat, 'seed': seed, 'cases': []}
+    for n, s, i in itertools.product(matrix['ngal'],matrix['nsim'],matrix['iterations']):
+        case = bench_case(n,s,i,seed=seed,method=method,repeat=repeat)
+        results['cases'].append(case)
+        if verbose:
+            print_case(case)
+    return results
+
+def print_case(case):
+    """
+    Print the stage timings, throughput and peak memory of one case
+    """
+    print("ngal {:7d} nsim {:7d} iterations {:3d}: simulate {:8.4f} s, initial fit {:8.4f} s, refit {:8.4f} s, "
+          "total {:8.4f} s, {:10.1f} sims/s, peak {:8.1f} MB".format(
+          case['ngal'],case['nsim'],case['iterations'],case['simulate_s'],case['initial_fit_s'],
+          case['refit_s'],case['total_s'],case['sims_per_s'],case['peak_mb']))
+
+def check_fitters(pecvels=(100.,300.,1000.,3000.),ngal=10,nsim=1000,iterations=3,h0=70.,distance=(5.,30.),
+                  disterr=(0.2,0.05),seed=0,rtol=1e-4,verbose=True):
+    """
+    Check that the batch fitter agrees with ODR over a range of peculiar velocities
+
+    The same catalogs are fit and refit with both methods. rtol, relative to each
+    fit and to h0 for fits near zero, allows for the convergence tolerance of ODR. Returns, for each pecvel, the number of
+    simulations whose initial fit and final refit h0 disagree, and the number of
+    non-finite batch fits; all are zero when the fitters agree. Well beyond 3000 km/s
+    ODR itself can stop at its iteration limit short of the minimum the batch fit finds.
+    """
+    counts = []
+    for pecvel in pecvels:
+        dist, derr, vel = galsim.simulate_catalogs(h0,distance,disterr,pecvel,ngal,nsim,seed)
+        fits = {}
+        for method in ('batch','odr'):
+            fit = galsim.fit_h0_batch(dist,derr,vel,method=method)
+            refit = galsim.refit_h0(dist,derr,vel,fit[0],iterations,method=method)
+            fits[method] = fit[0], refit[0][-1]
+        differ = [int(np.sum(~np.isclose(b,o,rtol=rtol,atol=rtol*h0))) for b, o in zip(fits['batch'],fits['odr'])]
+        nonfinite = int(np.sum(~np.isfinite(fits['batch'][0])) + np.sum(~np.isfinite(fits['batch'][1])))
+        counts.append({'pecvel': pecvel, 'initial_fit': differ[0], 'refit': differ[1], 'nonfinite': nonfinite})
+        if verbose:
+            print("pecvel {:8.1f}: {} of {} initial fits and {} refits differ from ODR, {} non-finite".format(
+                  pecvel,differ[0],nsim,differ[1],nonfinite))
+    return counts
+
+def write_benchmark(filename,results):
+    """
+    Write benchmark results to a JSON file
+    """
+    with open(filename,'w') as f:
+        json.dump(results,f,indent=1)
+
+def read_benchmark(filename):
+    """
+    Read benchmark results written by write_benchmark
+    """
+    with open(filename) as f:
+        return json.load(f)
+
+def compare_benchmarks(old,new,threshold=0.1):
+    """
+    Print the ratio of new to old stage times for the cases both runs share,
+    flagging cases more than threshold slower. Returns the flagged cases.
+    """
+    key = lambda case: (case['ngal'],case['nsim'],case['iterations'])
+    oldcases = {key(case): case for case in old['cases']}
+    stages = ['simulate_s','initial_fit_s','refit_s','total_s']
+    slower = []
+    for case in new['cases']:
+        if key(case) not in oldcases:
+            continue
+        ratios = [case[stage]/oldcases[key(case)][stage] for stage in stages]
+        flag = ratios[-1] > 1. + threshold
+        if flag:
+            slower.append(case)
+        print("ngal {:7d} nsim {:7d} iterations {:3d}: simulate x{:5.2f}, initial fit x{:5.2f}, refit x{:5.2f}, "
+              "total x{:5.2f}{}".format(*key(case),*ratios,'  SLOWER' if flag else ''))
+    return slower
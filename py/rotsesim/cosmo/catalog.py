@@ -0,0 +1,195 @@
+"""
+rotsesim.cosmo.catalog
+
+Fit h0 to real distance catalogs of distance, distance error and velocity
+columns stored as NumPy .npy, FITS or CSV files. The columns are memory-mapped
+and read in chunks, so catalogs of millions of rows are never copied into
+memory; CSV files are converted once to a cached .npy file. The same
+out-of-core fit used for chunked mock catalogs (galsim.refit_chunks) runs on
+the catalog itself and on copies perturbed by random peculiar velocities.
+"""
+
+import hashlib
+import os
+from functools import partial
+
+import numpy as np
+
+from rotsesim.mesa import count_lines, write_chunks
+from rotsesim.cosmo.galsim import refit_chunks, sim_blocks, imap_blocks, RunningStats, write_output
+
+#- Catalog quantities, in the order iteration yields them
+catalog_columns = ('distance','disterr','velocity')
+
+def cache_csv(filename,columns=catalog_columns,cachefile=None,chunksize=1000000):
+    """
+    Convert the columns of a CSV file (optionally gzipped) to a structured .npy file, once
+
+    The fields of the cache are named after the CSV columns read. The cache, by
+    default filename + '.<hash of the columns>.npy', is reused while it is newer than
+    the CSV file and holds the same columns. The CSV is read chunksize rows at a time
+    and written straight into the memory-mapped cache, so no full copy of the table
+    is ever held in memory. Returns the name of the cache file.
+    """
+    import pandas as pd
+
+    columns = tuple(columns)
+    if len(set(columns)) != len(columns):
+        raise ValueError("distance, distance error and velocity columns must differ, got {}".format(columns))
+    if cachefile is None:
+        cachefile = filename + '.' + hashlib.sha1(repr(columns).encode()).hexdigest()[:8] + '.npy'
+    if os.path.exists(cachefile) and os.path.getmtime(cachefile) >= os.path.getmtime(filename):
+        cached = np.load(cachefile,mmap_mode='r')
+        if cached.dtype.names == columns:
+            return cachefile
+
+    #- The line count of the decompressed text bounds the rows; the header and any blank lines leave spare rows
+    dtype = np.dtype([(name,np.float64) for name in columns])
+    chunks = pd.read_csv(filename,usecols=list(columns),dtype=np.float64,chunksize=chunksize)
+    write_chunks(cachefile,chunks,dtype,count_lines(filename) + 1,chunksize)
+    return cachefile
+
+class MappedCatalog:
+    """
+    Real catalog whose distance, distance error and velocity columns are memory-mapped from a file
+
+    filename is a .npy file holding a structured array with the named columns or an
+    (nrows, 3) array, or a FITS table (read with astropy, extension hdu). columns gives
+    the names (or indices) of the distance, distance error and velocity columns.
+    Iterating yields (distance, distance error, velocity) arrays of at most chunk rows,
+    like galsim.ChunkedCatalog, so the catalog can be passed to fit_h0_chunks.
+    The file is opened lazily and reopened after pickling, so catalogs can be sent to
+    worker processes without copying the data.
+    """
+    def __init__(self,filename,columns=catalog_columns,chunk=1000000,hdu=1):
+        self.filename = filename
+        self.columns  = columns
+        self.chunk    = chunk
+        self.hdu      = hdu
+        self._data    = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.filename.lower().endswith(('.fits','.fit','.fits.gz','.fit.gz')):
+                from astropy.io import fits
+                table = fits.open(self.filename,memmap=True)[self.hdu].data
+                self._data = [table.field(column) for column in self.columns]
+            else:
+                array = np.load(self.filename,mmap_mode='r')
+                if array.dtype.names is not None:
+                    self._data = [array[column] for column in self.columns]
+                else:
+                    self._data = [array[:,column] for column in range(3)]
+        return self._data
+
+    @property
+    def dtype(self):
+        """
+        Native working precision of the catalog columns
+        """
+        return np.result_type(*[column.dtype.newbyteorder('=') for column in self.data]).type
+
+    def __len__(self):
+        return len(self.data[0])
+
+    def __iter__(self):
+        dtype = self.dtype
+        for start in range(0,len(self),self.chunk):
+            yield tuple(np.asarray(column[start:start + self.chunk],dtype=dtype) for column in self.data)
+
+def load_catalog(filename,columns=catalog_columns,chunk=1000000,cachefile=None,hdu=1):
+    """
+    Open a .npy, FITS or CSV catalog as a MappedCatalog, converting CSV files to a cached .npy first
+    """
+    if filename.lower().endswith(('.csv','.csv.gz','.txt')):
+        return MappedCatalog(cache_csv(filename,columns,cachefile),columns,chunk=chunk)
+    if filename.lower().endswith('.npy') and columns == catalog_columns:
+        array = np.load(filename,mmap_mode='r')
+        if array.dtype.names is None:
+            columns = (0,1,2)
+    return MappedCatalog(filename,columns,chunk=chunk,hdu=hdu)
+
+class PerturbedCatalog:
+    """
+    A catalog whose velocities get extra peculiar velocities drawn uniformly from -pecvel to pecvel
+
+    Chunk c of perturbation sim draws from SeedSequence(entropy, spawn_key=(sim, c)),
+    so each pass over the catalog adds the same perturbations.
+    """
+    def __init__(self,catalog,pecvel,entropy,sim=0):
+        self.catalog = catalog
+        self.pecvel  = pecvel
+        self.entropy = entropy
+        self.sim     = sim
+        self.dtype   = catalog.dtype
+
+    def __iter__(self):
+        real = self.dtype
+        for c, (dist, derr, vel) in enumerate(self.catalog):
+            rng = np.random.default_rng(np.random.SeedSequence(self.entropy,spawn_key=(self.sim,c)))
+            vel = vel + real(2.*self.pecvel)*rng.random(vel.shape,dtype=real) - real(self.pecvel)
+            yield dist, derr, vel
+
+def perturb_block(catalog,pecvel,iterations,velerr,clip,tol,entropy,blocksize,block,nsim):
+    """
+    Fit and refit h0 for one block of nsim perturbed copies of a catalog
+
+    Returns the same arrays as galsim.simulate_block.
+    """
+    fits = [refit_chunks(PerturbedCatalog(catalog,pecvel,entropy,block*blocksize + i),iterations,velerr,clip,tol)
+            for i in range(nsim)]
+    fith0, h0err, chi2dof, nkept, nrefit = [np.array(values).T for values in zip(*fits)]
+    return fith0,h0err,chi2dof,nkept,nrefit
+
+def catalog_sim(catalog,nsim,iterations,pecvel,seed=None,workers=1,blocksize=10,velerr=300.,clip=3.,tol=1e-4,verbose=True,output=None):
+    """
+    Fit h0 to a real catalog and to nsim copies perturbed by random peculiar velocities
+
+    The catalog and every perturbed copy are fit and refit with galsim.refit_chunks.
+    Prints and returns a summary with the h0, error, chi2/dof and kept galaxies of the
+    catalog itself ('catalog') and the h0 average, rms, error and chi2 of the perturbed
+    copies in the keys used by pecvel_sim, and writes the per-copy values to output if given.
+    """
+    fit = refit_chunks(catalog,iterations,velerr,clip,tol)
+
+    entropy = np.random.SeedSequence(seed).entropy
+    func = partial(perturb_block,catalog,pecvel,iterations,velerr,clip,tol,entropy,blocksize)
+    h0stats   = RunningStats(iterations+1)
+    errstats  = RunningStats(iterations+1)
+    chi2stats = RunningStats(iterations+1)
+    keptstats = RunningStats(iterations+1)
+    nrefit    = np.zeros(iterations+1,dtype=int)
+    blocks    = []
+    for result in imap_blocks(func,sim_blocks(nsim,blocksize),workers):
+        h0stats.update(result[0])
+        errstats.update(result[1])
+        chi2stats.update(result[2])
+        keptstats.update(result[3])
+        nrefit += result[4].sum(axis=-1)
+        blocks.append(result[:4])
+
+    summary = {'nsim': nsim, 'ngal': len(catalog),
+               'catalog': {'h0': fit[0].tolist(), 'h0err': fit[1].tolist(), 'chi2dof': fit[2].tolist(), 'nkept': fit[3].tolist()},
+               'h0mean': h0stats.mean.tolist(), 'h0std': h0stats.std().tolist(),
+               'h0errmean': errstats.mean.tolist(), 'h0errstd': errstats.std().tolist(),
+               'chi2mean': chi2stats.mean.tolist(), 'nkeptmean': keptstats.mean.tolist(), 'nrefit': nrefit.tolist()}
+    if output is not None:
+        fith0, h0err, chi2dof, nkept = [np.hstack(values) for values in zip(*blocks)]
+        write_output(output,summary,fith0,h0err,chi2dof,nkept=nkept)
+
+    if verbose:
+        print("Catalog of {} galaxies, {} perturbations with pecvel = {:0.1f}".format(len(catalog),nsim,pecvel))
+        for iteration in range(iterations+1):
+            print("Initial fit" if iteration == 0 else "Iteration {}".format(iteration))
+            print("Catalog H0 = {:0.4f}, err = {:0.4f}, chi2 = {:0.4f}, kept galaxies = {}".format(
+                  fit[0][iteration],fit[1][iteration],fit[2][iteration],fit[3][iteration]))
+            print("Perturbed H0 average = {:0.4f}, rms = {:0.4f}, err = {:0.4f}".format(
+                  summary['h0mean'][iteration],summary['h0std'][iteration],summary['h0errmean'][iteration]))
+
+    return summary
@@ -7,9 +7,16 @@ then finds H0 using a linear fit, attempting to mitigate
 the effects of peculiar motion.
 """
 
+import json
+import os
+import warnings
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.odr import *
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+#- matplotlib and scipy.odr are imported only by the functions that use them,
+#- so batch runs never load a display backend or the ODR wrapper
 
 #- Define necessary functions for fitting and plotting
 def fit_velocity(distance, h0):
@@ -22,6 +29,7 @@ def fit_h0_disterrors(distance,disterr,velocity):
     """
     Use ODR to fit h0 using distance errors
     """
+    from scipy.odr import Model, RealData, ODR
     model   = Model(fit_velocity)
     data    = RealData(distance,velocity,sx=disterr)
     odr     = ODR(data,model,beta0=[0.])
@@ -36,6 +44,7 @@ def fit_h0_dist_vel_errors(distance,disterr,velocity,velerr,beta=None):
     """
     Use ODR to fit h0 using errors in distance and velocity
     """
+    from scipy.odr import Model, RealData, ODR
     if beta:
         beta0 = beta
     else:
@@ -51,28 +60,183 @@ def fit_h0_dist_vel_errors(distance,disterr,velocity,velerr,beta=None):
 
     return fith0,errh0,chi2dof,yerr
 
-def plot_h0_histogram(h0values,h0mean,h0std):
+#- Fraction of the large-h0 limit of the ODR objective above which batch fits are redone with ODR
+ill_posed = 0.2
+
+def descends(distance,vvar,dvar,velocity,keep,start,end,npoints=8):
+    """
+    True for each simulation whose ODR objective decreases steadily from start to end
+
+    The objective is evaluated at npoints steps along the line from each start to end
+    h0; a rise anywhere means a local method would stop at a minimum before end.
+    Non-finite ends are reported as False.
+    """
+    ok = np.isfinite(end)
+    path = np.where(ok,end,start) - start
+    eps = 100*np.finfo(np.result_type(distance,float)).eps
+    previous = None
+    with np.errstate(over='ignore',invalid='ignore',divide='ignore'):
+        for t in np.linspace(0.,1.,npoints + 1):
+            b = (start + t*path)[:,None]
+            chi2 = np.sum(keep*(velocity - b*distance)**2/(vvar + b**2*dvar),axis=-1)
+            if previous is not None:
+                ok &= chi2 <= previous*(1. + eps) + eps
+            previous = chi2
+    return ok
+
+def fit_h0_batch(distance,disterr,velocity,velerr=None,beta=None,method='batch',tol=1e-10,maxiter=100,mask=None):
+    """
+    Fit h0 for every simulation at once from (nsim, ngal) arrays
+
+    With method='batch' the ODR objective of the h0 * distance model,
+    which for a linear model reduces to sum((v - h0*d)**2 / (velerr**2 + h0**2*disterr**2)),
+    is minimized with Gauss-Newton steps on all simulations together, starting from
+    h0 = 0 as the ODR fit does (or from the warm start beta). This objective can have
+    several minima and falls towards a constant as h0 grows, so with large peculiar
+    velocities the steps can run away or reach a different minimum than ODR. Every
+    simulation whose fit is not finite, did not converge within maxiter, changed sign
+    from a nonzero start, is not reached by a steady descent of the objective from the
+    start (so a local method like ODR would stop at an earlier minimum), or whose
+    minimum is within a factor ill_posed of the large-h0 limit of the objective (where
+    ODR stops at its iteration limit) is refit with the ODR path, so the results match
+    scipy.odr to within its convergence tolerance.
+    With method='odr' each simulation is passed to fit_h0_disterrors or
+    fit_h0_dist_vel_errors, which reproduces the ODR h0, h0 error and chi2/dof
+    exactly; the velocity residuals are computed from the fit h0 as in the batch path.
+    Simulations refit with ODR make the batch fit as slow as method='odr' for them,
+    which at peculiar velocities of 1000 km/s and more can be most of them.
+
+    velerr=None fits with distance errors only (unit velocity weights, as RealData does).
+    mask is an optional boolean (nsim, ngal) array of the galaxies to fit; rejected
+    galaxies get zero weight.
+    Returns arrays of fit h0, h0 error, chi2/dof and velocity residuals (the ODR eps
+    that minimize the objective at the fit h0), with residuals given for every galaxy
+    including rejected ones.
+    """
+    distance = np.atleast_2d(distance)
+    disterr  = np.broadcast_to(disterr,distance.shape)
+    velocity = np.atleast_2d(velocity)
+    nsim, ngal = distance.shape
+    if beta is not None:
+        beta = np.broadcast_to(np.asarray(beta,dtype=float),(nsim,))
+    sy = 1. if velerr is None else velerr
+    vvar = np.broadcast_to(np.square(sy),distance.shape)
+    dvar = np.square(disterr)
+
+    if method == 'odr':
+        fith0   = np.empty(nsim)
+        errh0   = np.empty(nsim)
+        chi2dof = np.empty(nsim)
+        for sim in range(nsim):
+            keep = slice(None) if mask is None else mask[sim]
+            if velerr is None:
+                fith0[sim], errh0[sim], chi2dof[sim] = fit_h0_disterrors(distance[sim][keep],disterr[sim][keep],velocity[sim][keep])
+            else:
+                b0 = None if beta is None else beta[sim]
+                fith0[sim], errh0[sim], chi2dof[sim], eps = fit_h0_dist_vel_errors(distance[sim][keep],disterr[sim][keep],velocity[sim][keep],
+                                                                                    np.sqrt(vvar[sim][keep]),beta=b0)
+        b = fith0[:,None]
+        yerr = -(velocity - b*distance)*vvar/(vvar + b**2*dvar)
+        return fith0,errh0,chi2dof,yerr
+    elif method != 'batch':
+        raise ValueError("Unknown fit method {}".format(method))
+
+    if mask is None:
+        keep = np.ones(distance.shape)
+    else:
+        keep = np.broadcast_to(mask,distance.shape).astype(float)
+
+    #- Start from h0 = 0 like the ODR fit unless given a warm start
+    if beta is None:
+        fith0 = np.zeros(nsim)
+    else:
+        fith0 = np.array(beta,dtype=float)
+    start = fith0.copy()
+
+    #- Non-finite fits at large peculiar velocities are expected here; they are refit with ODR below
+    with np.errstate(over='ignore',invalid='ignore',divide='ignore'):
+        #- Gauss-Newton iterations with step halving whenever the objective would increase,
+        #- dropping simulations once their step is below tol
+        active = np.arange(nsim)
+        for it in range(maxiter):
+            x, y, vv, dv, kp = distance[active], velocity[active], vvar[active], dvar[active], keep[active]
+            b = fith0[active,None]
+            w = vv + b**2*dv
+            r = y - b*x
+            xfit = x + b*dv*r/w
+            chi2 = np.sum(kp*r**2/w,axis=-1)
+            step = np.sum(kp*r*xfit/w,axis=-1) / np.sum(kp*xfit**2/w,axis=-1)
+            scale = np.ones(active.size)
+            check = np.arange(active.size)
+            for halving in range(50):
+                bnew = b[check] + (scale*step)[check,None]
+                worse = np.sum(kp[check]*(y[check] - bnew*x[check])**2/(vv[check] + bnew**2*dv[check]),axis=-1) > chi2[check]
+                check = check[worse]
+                if check.size == 0:
+                    break
+                scale[check] *= 0.5
+            fith0[active] += scale*step
+            done = np.abs(scale*step) <= tol*np.abs(fith0[active])
+            active = active[~done]
+            if active.size == 0:
+                break
+
+        b = fith0[:,None]
+        w = vvar + b**2*dvar
+        r = velocity - b*distance
+        xfit = distance + b*dvar*r/w
+        chi2dof = np.sum(keep*r**2/w,axis=-1) / (np.sum(keep,axis=-1) - 1)
+        errh0 = np.sqrt(chi2dof / np.sum(keep*xfit**2/w,axis=-1))
+        yerr = -r*vvar/w
+
+    #- Refit the simulations the Gauss-Newton steps may have taken to another minimum with ODR.
+    #- The objective falls towards sum(d**2/disterr**2) as h0 grows; when the fit gets within
+    #- a factor ill_posed of that limit the minimum is too shallow for ODR to reach in its
+    #- iteration limit, so those simulations are left to ODR as well
+    chi2inf = np.sum(keep*np.divide(distance**2,dvar,out=np.full(distance.shape,np.inf),where=dvar > 0),axis=-1)
+    suspect = ~np.isfinite(fith0) | ~np.isfinite(errh0) | (chi2dof*(np.sum(keep,axis=-1) - 1) > ill_posed*chi2inf)
+    suspect[active] = True
+    suspect |= (start != 0) & (np.sign(fith0) != np.sign(start))
+    suspect |= ~descends(distance,vvar,dvar,velocity,keep,start,fith0)
+    redo = np.flatnonzero(suspect)
+    if redo.size > 0:
+        ve = None if velerr is None else np.sqrt(vvar[redo])
+        fit = fit_h0_batch(distance[redo],disterr[redo],velocity[redo],ve,beta=None if beta is None else beta[redo],
+                           method='odr',mask=None if mask is None else keep[redo].astype(bool))
+        fith0[redo], errh0[redo], chi2dof[redo], yerr[redo] = fit
+
+    return fith0,errh0,chi2dof,yerr
+
+def plot_h0_histogram(h0values,h0mean,h0std,hist=None):
     """
-    Plot histogram fit h0 values
+    Plot histogram fit h0 values, or the binned counts of a FixedHistogram
     """
-    nbins = np.int(np.max(h0values) - np.min(h0values))
+    import matplotlib.pyplot as plt
+    if hist is not None:
+        h0values, nbins, weights = hist.centers(), hist.edges, hist.counts
+    else:
+        nbins, weights = max(int(np.max(h0values) - np.min(h0values)),1), None
     plt.xlabel('H0',fontsize=20)
     plt.ylabel('counts per bin',fontsize=20)
     plt.title('H0 distribution (H0 mock: avg = {:0.4f}, std = {:0.4f}'.format(h0mean,h0std),fontsize=20)
-    plt.hist(h0values,bins=nbins)
+    plt.hist(h0values,bins=nbins,weights=weights)
     plt.xticks(fontsize=20)
     plt.yticks(fontsize=20)
     plt.show()
 
-def plot_h0errors_histogram(h0errors,h0errors_mean,h0errors_std):
+def plot_h0errors_histogram(h0errors,h0errors_mean,h0errors_std,hist=None):
     """
-    Plot histogram fit h0 errors
+    Plot histogram fit h0 errors, or the binned counts of a FixedHistogram
     """
-    nbins = np.int(np.max(h0errors) - np.min(h0errors))
+    import matplotlib.pyplot as plt
+    if hist is not None:
+        h0errors, nbins, weights = hist.centers(), hist.edges, hist.counts
+    else:
+        nbins, weights = max(int(np.max(h0errors) - np.min(h0errors)),1), None
     plt.xlabel('H0 errors',fontsize=20)
     plt.ylabel('counts per bin',fontsize=20)
     plt.title('H0 error distribution (H0 error: avg = {:0.4f}, std = {:0.4f}'.format(h0errors_mean,h0errors_std),fontsize=20)
-    plt.hist(h0errors,bins=nbins)
+    plt.hist(h0errors,bins=nbins,weights=weights)
     plt.xticks(fontsize=20)
     plt.yticks(fontsize=20)
     plt.show()
@@ -81,6 +245,7 @@ def plot_h0_mean_iterations(h0mean):
     """
     Plot progression of h0 mean after iterating
     """
+    import matplotlib.pyplot as plt
     plt.title('H0 average progression, final H0 = {:0.4f}'.format(h0mean[-1]),fontsize=20)
     plt.xlabel('iteration',fontsize=20)
     plt.ylabel('H0 mean',fontsize=20)
@@ -94,6 +259,7 @@ def plot_h0_std_iterations(h0std):
     """
     Plot progression of h0 rms after iterating
     """
+    import matplotlib.pyplot as plt
     plt.title('H0 rms progression, final H0 rms = {:0.4f}'.format(h0std[-1]),fontsize=20)
     plt.xlabel('iteration',fontsize=20)
     plt.ylabel('H0 rms',fontsize=20)
@@ -103,116 +269,607 @@ def plot_h0_std_iterations(h0std):
     plt.yticks(fontsize=20)
     plt.show()
 
-def pecvel_sim(h0,distance,disterr,pecvel,ngal,nsim,iterations,plothist,plotprog,seed):
-    if seed is not None:
-        np.random.seed(seed)
-        seeds = np.random.randint(2**30, size=nsim)
-
-    #- Generate ngal mock galaxies for nsim simulations
-    dist_all    = []
-    disterr_all = []
-    vel_all     = []
-    velerr_all  = []
-    fith0_all   = []
-    h0err       = []
-    totchi2     = []
-    for sim in range(nsim):
-        #- Simulate distances shifted by random amount based on measurement error
-        if seed:
-            np.random.seed(seeds[sim])
-        dist = np.random.uniform(distance[0],distance[1],ngal)
-        if seed:
-            np.random.seed(seeds[sim])
-        derr = np.random.normal(disterr[0],disterr[1],ngal)
-        disterror = dist*derr
-        vel = h0*dist
-        if seed:
-            np.random.seed(seeds[sim])
-        dist = dist + np.random.uniform(-np.abs(disterror),np.abs(disterror),ngal)
-        dist_all.append(dist)
-        disterr_all.append(disterror)
-
-        #- Simulate galaxy velocities including peculiar velocities
-        if seed:
-            np.random.seed(seeds[sim])
-        vpec = np.random.uniform(-pecvel,pecvel,ngal)
-        vel = vel + vpec
-        vel_all.append(vel)
-
-        #- Fit h0
-        fith0, errh0, chi2 = fit_h0_disterrors(dist,disterror,vel)
-        fith0_all.append(fith0)
-        h0err.append(errh0)
-        totchi2.append(chi2)
-
-        #- Save difference in velocities from fit as errors
-        fitvel = fith0 * dist
-        verr = fitvel - vel
-        velerr_all.append(verr)
-
-    h0mean = np.mean(fith0_all)
-    h0std = np.std(fith0_all)
-    h0errmean = np.mean(h0err)
-    chi2mean = np.mean(totchi2)
-
-    print("Initial fit of H0 average = {:0.4f}, rms = {:0.4f}, err = {:0.4f}, chi2 = {:0.4f}\n".format(h0mean,h0std,h0errmean,chi2mean))
+class RunningStats:
+    """
+    Online mean and rms along the last axis of a stream of value batches
 
-    #- Plot histogram of h0 values after inital fit
-    if plothist:
-        plot_h0_histogram(fith0_all,h0mean,h0std)
+    Batches are merged with the pairwise Welford update of Chan et al.,
+    so only the count, mean and sum of squared deviations are kept.
+    """
+    def __init__(self,shape=()):
+        self.count = 0
+        self.mean  = np.zeros(shape)
+        self.m2    = np.zeros(shape)
+
+    def update(self,values):
+        n = values.shape[-1]
+        if n == 0:
+            return
+        mean  = np.mean(values,axis=-1)
+        m2    = np.sum((values - mean[...,None])**2,axis=-1)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean  = self.mean + delta*n/total
+        self.m2    = self.m2 + m2 + delta**2*self.count*n/total
+        self.count = total
+
+    def std(self):
+        return np.sqrt(self.m2/self.count)
+
+class FixedHistogram:
+    """
+    Histogram with fixed bins accumulated over a stream of value batches
+    """
+    def __init__(self,low,high,nbins):
+        self.edges     = np.linspace(low,high,nbins+1)
+        self.counts    = np.zeros(nbins,dtype=np.int64)
+        self.underflow = 0
+        self.overflow  = 0
+
+    def update(self,values):
+        self.counts    += np.histogram(values,self.edges)[0]
+        self.underflow += np.count_nonzero(values < self.edges[0])
+        self.overflow  += np.count_nonzero(values > self.edges[-1])
+
+    def centers(self):
+        return 0.5*(self.edges[1:] + self.edges[:-1])
 
-    #- Refit h0 after taking errors into accounts and removing outliers
-    h0mean_tot = []
-    h0std_tot  = []
+    @classmethod
+    def from_counts(cls,edges,counts):
+        hist = cls(edges[0],edges[-1],len(counts))
+        hist.edges  = np.asarray(edges)
+        hist.counts = np.asarray(counts)
+        return hist
+
+def catalog_streams(seed=None):
+    """
+    Independent random generators for the distance, distance error,
+    distance shift and peculiar velocity draws, spawned from one seed
+    """
+    if not isinstance(seed,np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [np.random.default_rng(s) for s in seed.spawn(4)]
+
+def simulate_catalogs(h0,distance,disterr,pecvel,ngal,nsim,seed=None,dtype=np.float64,vfield=None):
+    """
+    Generate nsim mock catalogs of ngal galaxies as (nsim, ngal) arrays
+
+    Returns the measured distances, distance errors and velocities in the
+    working precision dtype (float64 or float32).
+    Peculiar velocities are drawn uniformly from -pecvel to pecvel, or sampled from
+    a correlated velocity field such as rotsesim.cosmo.pvfield.VelocityField.
+    """
+    rng_dist, rng_derr, rng_shift, rng_vpec = catalog_streams(seed)
+    dtype = np.dtype(dtype).type
+    shape = (nsim,ngal)
+
+    #- Simulate distances shifted by random amount based on measurement error
+    dist = dtype(distance[0]) + dtype(distance[1] - distance[0])*rng_dist.random(shape,dtype=dtype)
+    disterror = dist*(dtype(disterr[0]) + dtype(disterr[1])*rng_derr.standard_normal(shape,dtype=dtype))
+    vel = dtype(h0)*dist
+    if vfield is not None:
+        vpec = vfield.line_of_sight(rng_vpec,dist).astype(dtype)
+    dist += np.abs(disterror)*(dtype(2.)*rng_shift.random(shape,dtype=dtype) - dtype(1.))
+
+    #- Simulate galaxy velocities including peculiar velocities
+    if vfield is None:
+        vel += dtype(2.*pecvel)*rng_vpec.random(shape,dtype=dtype) - dtype(pecvel)
+    else:
+        vel += vpec
+
+    return dist,disterror,vel
+
+def refit_h0(distance,disterr,velocity,beta,iterations,velerr=300.,clip=3.,tol=1e-4,method='batch'):
+    """
+    Iteratively refit h0 with velocity errors, rejecting outliers
+
+    Each iteration refits the simulations that have not converged, warm started
+    from their previous h0, using only the galaxies kept so far. Galaxies whose
+    residual (v - h0*d)/sqrt(velerr**2 + h0**2*disterr**2) exceeds clip are then
+    rejected for the next iteration (clip=None keeps every galaxy). A simulation
+    converges, and keeps its values for the remaining iterations, once its h0
+    changes by less than tol and its kept galaxies no longer change.
+    Returns (iterations, nsim) arrays of fit h0, h0 error, chi2/dof, number of
+    kept galaxies and whether each simulation was refit at each iteration.
+    """
+    nsim, ngal = distance.shape
+    disterr = np.broadcast_to(disterr,distance.shape)
+    fith0   = np.empty((iterations,nsim))
+    h0err   = np.empty((iterations,nsim))
+    chi2dof = np.empty((iterations,nsim))
+    nkept   = np.empty((iterations,nsim),dtype=int)
+    nrefit  = np.zeros((iterations,nsim),dtype=int)
+
+    mask   = np.ones((nsim,ngal),dtype=bool)
+    beta   = np.array(beta,dtype=float)
+    active = np.arange(nsim)
     for iteration in range(iterations):
-        print("Iteration",iteration+1)
-        if iteration == 0:
-            dist_iter = dist_all
-            disterr_iter = disterr_all
-            vel_iter = vel_all
-            velerr_iter = 300.*np.ones(len(velerr_all))
-            beta = fith0_all
+        if iteration > 0:
+            fith0[iteration], h0err[iteration], chi2dof[iteration], nkept[iteration] = fith0[iteration-1], h0err[iteration-1], chi2dof[iteration-1], nkept[iteration-1]
+        if active.size == 0:
+            continue
+        nrefit[iteration,active] = 1
+
+        #- Refit the simulations still iterating
+        x, dx, v, keep = distance[active], disterr[active], velocity[active], mask[active]
+        h0new, errnew, chi2new, yerr = fit_h0_batch(x,dx,v,velerr,beta=beta[active],method=method,mask=keep)
+        fith0[iteration,active], h0err[iteration,active], chi2dof[iteration,active] = h0new, errnew, chi2new
+        nkept[iteration,active] = np.sum(keep,axis=-1)
+
+        #- Reject outliers from the new fit, always keeping at least two galaxies
+        if clip is not None:
+            b = h0new[:,None]
+            resid = np.abs(v - b*x)/np.sqrt(np.square(velerr) + b**2*dx**2)
+            newkeep = resid <= clip
+            enough = np.sum(newkeep,axis=-1) >= 2
+            newkeep[~enough] = keep[~enough]
         else:
-            velerr_iter = 300.*np.ones(len(velerr_all))
-            beta = fith0_iter
+            newkeep = keep
+        mask[active] = newkeep
 
-        fith0_iter      = []
-        velerr_iter_new = []
-        h0err_iter      = []
-        chi2_iter       = []
-        for sim in range(len(dist_iter)):
-            #- Fit h0, update velocity errors, refit
-            fith0_new, h0err, chi2, yerr = fit_h0_dist_vel_errors(dist_iter[sim],disterr_iter[sim],vel_iter[sim],velerr_iter[sim],beta=beta[sim])
+        #- Drop simulations whose h0 and kept galaxies have stopped changing
+        converged = (np.abs(h0new - beta[active]) < tol) & np.all(newkeep == keep,axis=-1)
+        beta[active] = h0new
+        active = active[~converged]
 
-            #- Calculate new velocity errors
-            fitvel_new = fith0_new * dist_iter[sim]
-            velerr_new = 300.*np.ones(ngal)
+    return fith0,h0err,chi2dof,nkept,nrefit
 
-            fith0_iter.append(fith0_new)
-            velerr_iter_new.append(velerr_new)
-            h0err_iter.append(h0err)
-            chi2_iter.append(chi2)
+def simulate_block(h0,distance,disterr,pecvel,ngal,iterations,method,velerr,clip,tol,entropy,block,nsim,vfield=None):
+    """
+    Simulate one block of nsim catalogs, fit h0 and refit it for all iterations
 
-        h0mean_iter = np.mean(fith0_iter)
-        h0std_iter = np.std(fith0_iter)
+    The block draws from SeedSequence(entropy, spawn_key=(block,)), so its
+    results do not depend on which process runs it.
+    Returns (iterations+1, nsim) arrays of fit h0, h0 error, chi2/dof, number of
+    kept galaxies and whether each simulation was fit at each iteration, where row 0
+    is the initial fit.
+    """
+    seed = np.random.SeedSequence(entropy,spawn_key=(block,))
+    dist, derr, vel = simulate_catalogs(h0,distance,disterr,pecvel,ngal,nsim,seed,vfield=vfield)
 
-        h0mean_tot.append(h0mean_iter)
-        h0std_tot.append(h0std_iter)
+    fith0, h0err, chi2dof, yerr = fit_h0_batch(dist,derr,vel,method=method)
 
-        h0errmean_iter = np.mean(h0err_iter)
-        h0errstd_iter = np.std(h0err_iter)
-        chi2mean_iter = np.mean(chi2_iter)
+    #- Refit h0 after taking errors into account and removing outliers
+    refit = refit_h0(dist,derr,vel,fith0,iterations,velerr=velerr,clip=clip,tol=tol,method=method)
 
-        print("H0 average = {:0.4f}, rms = {:0.4f}, err = {:0.4f}, rmserr = {:0.4f}\n".format(h0mean_iter,h0std_iter,h0errmean_iter,h0errstd_iter))
+    fith0   = np.vstack([fith0,refit[0]])
+    h0err   = np.vstack([h0err,refit[1]])
+    chi2dof = np.vstack([chi2dof,refit[2]])
+    nkept   = np.vstack([np.full(nsim,ngal),refit[3]])
+    nrefit  = np.vstack([np.ones(nsim,dtype=int),refit[4]])
 
-    #- Plot histogram of h0 values after final fit
+    return fith0,h0err,chi2dof,nkept,nrefit
+
+class ChunkedCatalog:
+    """
+    Mock catalog of ngal galaxies generated chunk by chunk, so it never has to fit in memory
+
+    Chunk c of simulation sim draws from SeedSequence(entropy, spawn_key=(sim, c)),
+    so iterating over the catalog again regenerates exactly the same galaxies.
+    Iterating yields (distance, distance error, velocity) arrays of at most chunk galaxies.
+    """
+    def __init__(self,h0,distance,disterr,pecvel,ngal,chunk,entropy,sim=0,dtype=np.float64):
+        self.h0       = h0
+        self.distance = distance
+        self.disterr  = disterr
+        self.pecvel   = pecvel
+        self.ngal     = ngal
+        self.chunk    = chunk
+        self.entropy  = entropy
+        self.sim      = sim
+        self.dtype    = dtype
+
+    def __iter__(self):
+        for c, start in enumerate(range(0,self.ngal,self.chunk)):
+            seed = np.random.SeedSequence(self.entropy,spawn_key=(self.sim,c))
+            dist, derr, vel = simulate_catalogs(self.h0,self.distance,self.disterr,self.pecvel,
+                                                min(self.chunk,self.ngal - start),1,seed,dtype=self.dtype)
+            yield dist[0], derr[0], vel[0]
+
+def h0_chunk_sums(catalog,h0,velerr=None,clip=None,cliph0=None):
+    """
+    Accumulate the ODR objective terms of the h0 * distance model over the chunks of a catalog
+
+    Galaxies more than clip sigma from the cliph0 fit are left out. The sums are
+    accumulated in float64 whatever the working precision of the chunks.
+    Returns chi2, the Gauss-Newton numerator and denominator and the number of galaxies used.
+    """
+    chi2 = grad = curv = 0.
+    nkept = 0
+    for x, dx, v in catalog:
+        #- Work in the precision of the chunk
+        real = x.dtype.type
+        b    = real(h0)
+        vvar = np.square(real(1. if velerr is None else velerr))
+        dvar = np.square(dx)
+        w = vvar + b**2*dvar
+        r = v - b*x
+        xfit = x + b*dvar*r/w
+        if clip is not None:
+            bc = real(cliph0)
+            keep = np.abs(v - bc*x) <= real(clip)*np.sqrt(vvar + bc**2*dvar)
+            w = np.where(keep,w,np.inf)
+            nkept += np.count_nonzero(keep)
+        else:
+            nkept += x.size
+        chi2 += np.sum(r**2/w,dtype=np.float64)
+        grad += np.sum(r*xfit/w,dtype=np.float64)
+        curv += np.sum(xfit**2/w,dtype=np.float64)
+    return chi2,grad,curv,nkept
+
+def fit_h0_chunks(catalog,velerr=None,beta=None,clip=None,cliph0=None,tol=1e-10,maxiter=100):
+    """
+    Fit h0 to a catalog too large for memory, one pass over its chunks per step
+
+    Minimizes the same objective as fit_h0_batch with Gauss-Newton steps and step halving,
+    to a relative tolerance no finer than the working precision of the catalog.
+    Returns fit h0, h0 error, chi2/dof and the number of galaxies used.
+    """
+    #- Without a warm start the first Gauss-Newton step from zero is the weighted least-squares slope
+    fith0 = 0. if beta is None else float(beta)
+    chi2, grad, curv, nkept = h0_chunk_sums(catalog,fith0,velerr,clip,cliph0)
+    if beta is None:
+        fith0 = grad/curv
+        chi2, grad, curv, nkept = h0_chunk_sums(catalog,fith0,velerr,clip,cliph0)
+
+    #- Steps smaller than the working precision can resolve count as converged
+    tol = max(tol,10.*np.finfo(catalog.dtype).eps)
+    for it in range(maxiter):
+        step = grad/curv
+        scale = 1.
+        while abs(scale*step) > tol*abs(fith0):
+            trial = h0_chunk_sums(catalog,fith0 + scale*step,velerr,clip,cliph0)
+            if trial[0] <= chi2:
+                break
+            scale *= 0.5
+        if abs(scale*step) <= tol*abs(fith0):
+            break
+        fith0 += scale*step
+        chi2, grad, curv, nkept = trial
+
+    chi2dof = chi2/(nkept - 1)
+    errh0 = np.sqrt(chi2dof/curv)
+    return fith0,errh0,chi2dof,nkept
+
+def refit_chunks(catalog,iterations,velerr=300.,clip=3.,tol=1e-4):
+    """
+    Fit h0 to a chunked catalog and refit it for all iterations
+
+    The refit iterations follow refit_h0, except that the catalog converges once its
+    h0 changes by less than tol and its number of kept galaxies stops changing.
+    Returns (iterations+1,) arrays of fit h0, h0 error, chi2/dof, kept galaxies and
+    whether the catalog was fit at each iteration, where element 0 is the initial fit.
+    """
+    fith0   = np.empty(iterations+1)
+    h0err   = np.empty(iterations+1)
+    chi2dof = np.empty(iterations+1)
+    nkept   = np.empty(iterations+1,dtype=int)
+    nrefit  = np.zeros(iterations+1,dtype=int)
+    nrefit[0] = 1
+    fith0[0], h0err[0], chi2dof[0], nkept[0] = fit_h0_chunks(catalog)
+
+    #- Refit h0 with velocity errors, rejecting galaxies that were outliers from the previous fit
+    converged = False
+    for iteration in range(1,iterations+1):
+        if converged:
+            fith0[iteration], h0err[iteration], chi2dof[iteration], nkept[iteration] = fith0[iteration-1], h0err[iteration-1], chi2dof[iteration-1], nkept[iteration-1]
+            continue
+        nrefit[iteration] = 1
+        cliph0 = None if iteration == 1 else fith0[iteration-1]
+        fith0[iteration], h0err[iteration], chi2dof[iteration], nkept[iteration] = fit_h0_chunks(
+            catalog,velerr,beta=fith0[iteration-1],clip=None if iteration == 1 else clip,cliph0=cliph0)
+        converged = iteration > 1 and abs(fith0[iteration] - fith0[iteration-1]) < tol and nkept[iteration] == nkept[iteration-1]
+
+    return fith0,h0err,chi2dof,nkept,nrefit
+
+def simulate_chunked_block(h0,distance,disterr,pecvel,ngal,iterations,velerr,clip,tol,galchunk,dtype,blocksize,entropy,block,nsim):
+    """
+    Fit and refit h0 for one block of simulations whose catalogs are streamed in chunks of galchunk galaxies
+
+    Each simulation is a ChunkedCatalog, so memory is set by galchunk rather than ngal,
+    and is fit by refit_chunks. Returns the same arrays as simulate_block.
+    """
+    fits = [refit_chunks(ChunkedCatalog(h0,distance,disterr,pecvel,ngal,galchunk,entropy,block*blocksize + i,dtype),
+                         iterations,velerr,clip,tol) for i in range(nsim)]
+    fith0, h0err, chi2dof, nkept, nrefit = [np.array(values).T for values in zip(*fits)]
+    return fith0,h0err,chi2dof,nkept,nrefit
+
+def sim_blocks(nsim,blocksize,first=None):
+    """
+    Split nsim simulations into (block, size) pairs of at most blocksize simulations
+
+    With first, the blocks start at first simulations and double in size up to
+    blocksize, so a run that stops early never simulates much more than it uses.
+    Block sizes depend only on these arguments, never on the number of workers.
+    """
+    block, start, size = 0, 0, blocksize if first is None else max(min(first,blocksize),1)
+    while start < nsim:
+        yield block, min(size,nsim - start)
+        block, start, size = block + 1, start + size, min(2*size,blocksize)
+
+def imap_blocks(func,blocks,workers=1):
+    """
+    Apply func(block, size) to every block, in a process pool if workers > 1
+
+    Results are yielded in block order whatever the number of workers,
+    with at most two blocks per worker in flight to bound memory.
+    """
+    if workers is None or workers <= 1:
+        for block, size in blocks:
+            yield func(block,size)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        try:
+            for block, size in blocks:
+                pending.append(pool.submit(func,block,size))
+                if len(pending) >= 2*workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+summary_keys = ['h0mean','h0std','h0errmean','h0errstd','chi2mean','nkeptmean','nrefit']
+
+def write_output(filename,summary,fith0=None,h0err=None,chi2dof=None,hists=None,nkept=None):
+    """
+    Write per-simulation h0, h0 error, chi2/dof and kept galaxies and the per-iteration summaries to a columnar file
+
+    A .parquet filename writes a Parquet table (requires pyarrow) with one row per
+    simulation and columns h0_<i>, h0err_<i>, chi2_<i>, nkept_<i> for iteration i (0 is the
+    initial fit), with the summaries stored in the file metadata. A filename ending in a
+    path separator, or an existing directory, gets one uncompressed .npy file per
+    (iterations+1, nsim) array h0, h0err, chi2 and nkept (and per histogram array) and
+    the summaries in summary.json, so the arrays can be memory-mapped. Any other filename
+    writes a compressed NumPy .npz with the same arrays.
+    The per-iteration summaries use their own keys (summary_keys, e.g. nkeptmean for the
+    average of nkept), so they never collide with the per-simulation arrays.
+    Streaming runs keep no per-simulation values and write their histograms instead.
+    """
+    hists = hists or {}
+    if filename.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        nstage = len(summary['h0mean'])
+        columns = {}
+        for name, values in [('h0',fith0),('h0err',h0err),('chi2',chi2dof),('nkept',nkept)]:
+            for stage in range(nstage):
+                columns['{}_{}'.format(name,stage)] = np.empty(0) if values is None else values[stage]
+        meta = dict(summary)
+        meta.update({key: np.asarray(value).tolist() for key, value in hists.items()})
+        table = pa.table(columns).replace_schema_metadata({'galsim': json.dumps(meta)})
+        pq.write_table(table,filename,compression='zstd')
+    elif filename.endswith(os.sep) or os.path.isdir(filename):
+        os.makedirs(filename,exist_ok=True)
+        arrays = dict(hists)
+        if fith0 is not None:
+            arrays.update(h0=fith0,h0err=h0err,chi2=chi2dof,nkept=nkept)
+        for key, values in arrays.items():
+            np.save(os.path.join(filename,key + '.npy'),np.asarray(values))
+        with open(os.path.join(filename,'summary.json'),'w') as f:
+            json.dump(summary,f,indent=1)
+    else:
+        arrays = {key: np.asarray(summary[key]) for key in summary_keys}
+        arrays.update({key: summary[key] for key in ('nsim','stderr') if key in summary})
+        if fith0 is not None:
+            arrays.update(h0=fith0,h0err=h0err,chi2=chi2dof,nkept=nkept)
+        arrays.update(hists)
+        np.savez_compressed(filename,**arrays)
+
+def read_output(filename):
+    """
+    Read a file written by write_output into a dictionary of arrays
+
+    The .npy arrays of an output directory are memory-mapped. Parquet files and
+    .npz members are compressed, so they are decompressed into memory when read
+    (.npz members only when accessed).
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename,memory_map=True)
+        meta = json.loads(table.schema.metadata[b'galsim'])
+        out = {key: np.asarray(value) for key, value in meta.items()}
+        if table.num_rows > 0:
+            nstage = len(meta['h0mean'])
+            for name in ['h0','h0err','chi2','nkept']:
+                out[name] = np.array([table.column('{}_{}'.format(name,stage)).to_numpy() for stage in range(nstage)])
+        return out
+    if os.path.isdir(filename):
+        with open(os.path.join(filename,'summary.json')) as f:
+            out = {key: np.asarray(value) for key, value in json.load(f).items()}
+        for name in sorted(os.listdir(filename)):
+            if name.endswith('.npy'):
+                out[name[:-4]] = np.load(os.path.join(filename,name),mmap_mode='r')
+        return out
+    return np.load(filename)
+
+def plot_output(filename,plothist=True,plotprog=True):
+    """
+    Plot the h0 histograms and progression plots of a file written by write_output
+    """
+    out = read_output(filename)
+    h0mean, h0std = out['h0mean'], out['h0std']
+    h0errmean, h0errstd = out['h0errmean'], out['h0errstd']
+    iterations = len(h0mean) - 1
     if plothist:
-        plot_h0_histogram(fith0_iter,h0mean_iter,h0std_iter)
-        plot_h0errors_histogram(h0err_iter,h0errmean_iter,h0errstd_iter)
+        if 'h0' in out:
+            h0, h0err = out['h0'], out['h0err']
+            plot_h0_histogram(h0[0],h0mean[0],h0std[0])
+            if iterations > 0:
+                plot_h0_histogram(h0[-1],h0mean[-1],h0std[-1])
+                plot_h0errors_histogram(h0err[-1],h0errmean[-1],h0errstd[-1])
+        else:
+            plot_h0_histogram(None,h0mean[0],h0std[0],hist=FixedHistogram.from_counts(out['h0hist_edges'],out['h0hist_initial']))
+            if iterations > 0:
+                plot_h0_histogram(None,h0mean[-1],h0std[-1],hist=FixedHistogram.from_counts(out['h0hist_edges'],out['h0hist_final']))
+                plot_h0errors_histogram(None,h0errmean[-1],h0errstd[-1],hist=FixedHistogram.from_counts(out['errhist_edges'],out['errhist_final']))
+    if plotprog and iterations > 0:
+        plot_h0_mean_iterations(h0mean[1:])
+        plot_h0_std_iterations(h0std[1:])
+
+def h0_stderr(stats,target='mean'):
+    """
+    Standard error of the final-iteration h0 average (target='mean') or rms (target='rms')
+    """
+    return standard_error(stats.std()[-1],stats.count,target)
+
+def standard_error(std,n,target='mean'):
+    """
+    Standard error of an average (target='mean') or rms (target='rms') of n values with rms std
+    """
+    if target == 'rms':
+        return std/np.sqrt(2.*(n - 1))
+    return std/np.sqrt(n)
+
+def tolerance_reached(stats,values,tolerance,target='mean',min_nsim=30):
+    """
+    Number of the next values after which the h0 standard error first falls below tolerance
+
+    stats holds the final-iteration h0 of the simulations so far and values the
+    final-iteration h0 of the next block, in order. The standard error is checked
+    after every simulation of the block, as if each prefix of it were added to
+    stats, so the stopping point does not depend on the block size. The rule only
+    fires from min_nsim simulations on (and never below two), as the rms of a few
+    simulations can be far too small. Returns None if the standard error stays
+    above tolerance for the whole block.
+    """
+    k = np.arange(1,values.size + 1)
+    shifted = values - values[0]
+    mean = np.cumsum(shifted)/k
+    m2 = np.maximum(np.cumsum(shifted**2) - k*mean**2,0.)
+    n = stats.count + k
+    delta = mean + values[0] - stats.mean[-1]
+    std = np.sqrt((stats.m2[-1] + m2 + delta**2*stats.count*k/n)/n)
+    ok = np.flatnonzero(n >= max(min_nsim,2))
+    below = ok[standard_error(std[ok],n[ok],target) < tolerance]
+    return below[0] + 1 if below.size > 0 else None
+
+def pecvel_sim(h0,distance,disterr,pecvel,ngal,nsim,iterations,plothist,plotprog,seed,method='batch',workers=1,blocksize=1000,stream=False,h0range=None,nbins=None,verbose=True,output=None,tolerance=None,target='mean',min_nsim=30,velerr=300.,clip=3.,tol=1e-4,galchunk=None,dtype=np.float64,vfield=None):
+    """
+    Simulate nsim catalogs of ngal galaxies with peculiar velocities, fit h0 and refit it
+
+    Prints and returns the h0 average, rms, error and chi2 of the initial fit
+    and of every refit iteration, and writes them to output if given.
+    With a tolerance, simulations are run until the standard error of the final h0
+    average (target='mean') or rms (target='rms') falls below it, with nsim as the
+    maximum number of simulations and at least min_nsim used. The standard error
+    is checked after every simulation and the block holding the stopping point is
+    cut there; blocks start at min_nsim simulations and double up to blocksize, so
+    an early stop costs little more than the simulations it uses. The number of
+    simulations used does not depend on the number of workers.
+    The refit iterations use velocity errors velerr and reject galaxies more than
+    clip sigma from the fit; see refit_h0.
+    With galchunk, each catalog is generated and fit in chunks of galchunk galaxies
+    in working precision dtype, so memory no longer grows with ngal.
+    With vfield, peculiar velocities are sampled from a correlated velocity field
+    (see rotsesim.cosmo.pvfield) instead of the uniform draw.
+    """
+    #- Every block of simulations gets its own stream spawned from the seed,
+    #- so the results are identical for any number of workers
+    entropy = np.random.SeedSequence(seed).entropy
+    if galchunk is None:
+        simfunc = partial(simulate_block,h0,distance,disterr,pecvel,ngal,iterations,method,velerr,clip,tol,entropy,vfield=vfield)
+    elif vfield is not None:
+        raise ValueError("A velocity field cannot be used with galchunk")
+    else:
+        simfunc = partial(simulate_chunked_block,h0,distance,disterr,pecvel,ngal,iterations,velerr,clip,tol,galchunk,dtype,blocksize,entropy)
+
+    #- Blocks are the unit of parallelism, so workers beyond the number of blocks sit idle
+    nblocks = -(-nsim // blocksize)
+    if tolerance is None and workers is not None and workers > nblocks:
+        warnings.warn("{} workers share only {} block(s) of {} simulations; lower blocksize to use them all".format(workers,nblocks,blocksize))
+
+    #- Online statistics are always kept for the stopping rule; streaming runs also
+    #- fold each block into fixed-bin histograms and keep no per-simulation arrays
+    h0stats   = RunningStats(iterations+1)
+    errstats  = RunningStats(iterations+1)
+    chi2stats = RunningStats(iterations+1)
+    keptstats = RunningStats(iterations+1)
+    nrefit    = np.zeros(iterations+1,dtype=int)
+    if stream:
+        if h0range is None:
+            h0range = (0.,2.*h0)
+        if nbins is None:
+            nbins = max(int(h0range[1] - h0range[0]),1)
+        h0hist  = [FixedHistogram(h0range[0],h0range[1],nbins) for stage in (0,-1)]
+        errhist = FixedHistogram(0.,0.5*(h0range[1] - h0range[0]),nbins)
+    else:
+        h0hist  = [None,None]
+        errhist = None
+        blocks  = []
+
+    #- Generate ngal mock galaxies for nsim simulations and fit h0, shared across workers
+    results = imap_blocks(simfunc,sim_blocks(nsim,blocksize,None if tolerance is None else min_nsim),workers)
+    for fith0, h0err, chi2dof, nkept, nrefit_block in results:
+        stop = None if tolerance is None else tolerance_reached(h0stats,fith0[-1],tolerance,target,min_nsim)
+        if stop is not None:
+            fith0, h0err, chi2dof, nkept, nrefit_block = [values[:,:stop] for values in (fith0,h0err,chi2dof,nkept,nrefit_block)]
+        h0stats.update(fith0)
+        errstats.update(h0err)
+        chi2stats.update(chi2dof)
+        keptstats.update(nkept)
+        nrefit += nrefit_block.sum(axis=-1)
+        if stream:
+            h0hist[0].update(fith0[0])
+            h0hist[1].update(fith0[-1])
+            errhist.update(h0err[-1])
+        else:
+            blocks.append((fith0,h0err,chi2dof,nkept))
+        if stop is not None:
+            break
+    results.close()
+    nsim = h0stats.count
+
+    if stream:
+        h0mean, h0std = h0stats.mean, h0stats.std()
+        h0errmean, h0errstd = errstats.mean, errstats.std()
+        chi2mean = chi2stats.mean
+        fith0 = h0err = chi2dof = nkept = None
+    else:
+        fith0, h0err, chi2dof, nkept = [np.concatenate(r,axis=1) for r in zip(*blocks)]
+        h0mean, h0std = np.mean(fith0,axis=1), np.std(fith0,axis=1)
+        h0errmean, h0errstd = np.mean(h0err,axis=1), np.std(h0err,axis=1)
+        chi2mean = np.mean(chi2dof,axis=1)
+
+    summary = {'nsim': nsim, 'h0mean': h0mean.tolist(), 'h0std': h0std.tolist(),
+               'h0errmean': h0errmean.tolist(), 'h0errstd': h0errstd.tolist(), 'chi2mean': chi2mean.tolist(),
+               'nkeptmean': keptstats.mean.tolist(), 'nrefit': nrefit.tolist()}
+    if tolerance is not None:
+        summary['stderr'] = h0_stderr(h0stats,target)
+        if verbose:
+            print("Used {} simulations, standard error of H0 {} = {:0.4f} (tolerance {:0.4f})\n".format(nsim,'average' if target == 'mean' else target,summary['stderr'],tolerance))
+    if output is not None:
+        if stream:
+            hists = {'h0hist_edges': h0hist[0].edges, 'h0hist_initial': h0hist[0].counts, 'h0hist_final': h0hist[1].counts,
+                     'errhist_edges': errhist.edges, 'errhist_final': errhist.counts}
+            write_output(output,summary,hists=hists)
+        else:
+            write_output(output,summary,fith0,h0err,chi2dof,nkept=nkept)
+
+    if verbose:
+        print("Initial fit of H0 average = {:0.4f}, rms = {:0.4f}, err = {:0.4f}, chi2 = {:0.4f}\n".format(h0mean[0],h0std[0],h0errmean[0],chi2mean[0]))
+
+    #- Plot histogram of h0 values after inital fit
+    if plothist:
+        plot_h0_histogram(None if stream else fith0[0],h0mean[0],h0std[0],hist=h0hist[0])
+
+    #- Summarize h0 after each refit
+    for iteration in range(1,iterations+1):
+        if verbose:
+            print("Iteration",iteration)
+            print("Kept galaxies per simulation = {:0.2f}, simulations refit = {}".format(keptstats.mean[iteration],nrefit[iteration]))
+            print("H0 average = {:0.4f}, rms = {:0.4f}, err = {:0.4f}, rmserr = {:0.4f}\n".format(h0mean[iteration],h0std[iteration],h0errmean[iteration],h0errstd[iteration]))
+
+    #- Plot histogram of h0 values after final fit
+    if plothist and iterations > 0:
+        plot_h0_histogram(None if stream else fith0[-1],h0mean[-1],h0std[-1],hist=h0hist[1])
+        plot_h0errors_histogram(None if stream else h0err[-1],h0errmean[-1],h0errstd[-1],hist=errhist)
 
     #- Plot progression of h0 average and rms
     if plotprog:
-        plot_h0_mean_iterations(h0mean_tot)
-        plot_h0_std_iterations(h0std_tot)
+        plot_h0_mean_iterations(h0mean[1:])
+        plot_h0_std_iterations(h0std[1:])
 
-    
+    return summary
@@ -0,0 +1,103 @@
+"""
+rotsesim.cosmo.pvfield
+
+Spatially correlated peculiar velocities for the galaxy simulation.
+A Gaussian random density field with a given power spectrum is drawn on
+a periodic FFT grid, turned into a linear-theory velocity field
+(v(k) proportional to i k delta(k) / k**2) and interpolated to the
+positions of the mock galaxies, with the observer at the grid origin.
+"""
+
+import numpy as np
+from scipy import fft
+
+def default_power(k,k0=0.02):
+    """
+    Density power spectrum shape rising as k on large scales and falling
+    as k**-3 past the turnover at k0 (in 1/Mpc)
+    """
+    return k/(1. + (k/k0)**2)**2
+
+class VelocityField:
+    """
+    Gaussian random peculiar velocity field on a periodic grid of ngrid**3 cells of side boxsize/ngrid (Mpc)
+
+    The wavenumber grid and the transfer function from white noise to the three
+    velocity components are built once and reused for every realization, so each
+    realization costs one forward and three inverse real FFTs. The field is
+    normalized so that its line-of-sight rms is sigma (km/s). smoothing (Mpc)
+    applies a Gaussian filter, by default one grid cell.
+    """
+    def __init__(self,boxsize,ngrid,sigma,power=default_power,smoothing=None,workers=None):
+        self.boxsize = boxsize
+        self.ngrid   = ngrid
+        self.sigma   = sigma
+        self.workers = workers
+        if smoothing is None:
+            smoothing = boxsize/ngrid
+
+        #- Wavenumbers in the rfftn layout; the Nyquist plane carries no gradient
+        kf = 2.*np.pi/boxsize
+        kx = fft.fftfreq(ngrid,d=1./ngrid)*kf
+        kz = fft.rfftfreq(ngrid,d=1./ngrid)*kf
+        kgrad  = [kx.copy(),kx.copy(),kz.copy()]
+        if ngrid % 2 == 0:
+            kgrad[0][ngrid//2] = kgrad[1][ngrid//2] = kgrad[2][-1] = 0.
+        k2 = kx[:,None,None]**2 + kx[None,:,None]**2 + kz[None,None,:]**2
+        amp = np.zeros(k2.shape)
+        nonzero = k2 > 0
+        amp[nonzero] = np.sqrt(power(np.sqrt(k2[nonzero])))/k2[nonzero]*np.exp(-0.5*k2[nonzero]*smoothing**2)
+        self.transfer = np.array([1j*kgrad[0][:,None,None]*amp,
+                                  1j*kgrad[1][None,:,None]*amp,
+                                  1j*kgrad[2][None,None,:]*amp])
+
+        #- Normalize the variance of unit white noise passed through the transfer function;
+        #- rfftn stores the modes with 0 < kz < Nyquist once for each conjugate pair
+        weight = np.full(kz.size,2.)
+        weight[0] = 1.
+        if ngrid % 2 == 0:
+            weight[-1] = 1.
+        variance = np.mean([np.sum(weight*np.abs(t)**2) for t in self.transfer])/ngrid**3
+        self.transfer *= sigma/np.sqrt(variance)
+
+    def realize(self,rng):
+        """
+        Draw one realization of the field, returned as a (3, ngrid, ngrid, ngrid) array of velocities
+        """
+        n = self.ngrid
+        noise = fft.rfftn(rng.standard_normal((n,n,n)),workers=self.workers)
+        return fft.irfftn(self.transfer*noise,s=(n,n,n),axes=(1,2,3),workers=self.workers)
+
+    def interpolate(self,velocity,positions):
+        """
+        Trilinearly interpolate a realization to (ngal, 3) positions in Mpc, wrapping periodically
+        """
+        n = self.ngrid
+        grid = positions*(n/self.boxsize)
+        base = np.floor(grid)
+        frac = grid - base
+        base = base.astype(int)
+        out = np.zeros((3,len(positions)))
+        for corner in range(8):
+            offset = [(corner >> axis) & 1 for axis in range(3)]
+            index = [(base[:,axis] + offset[axis]) % n for axis in range(3)]
+            weight = np.prod([frac[:,axis] if offset[axis] else 1. - frac[:,axis] for axis in range(3)],axis=0)
+            out += weight*velocity[:,index[0],index[1],index[2]]
+        return out.T
+
+    def line_of_sight(self,rng,distance):
+        """
+        Peculiar line-of-sight velocities of galaxies at the given distances (Mpc)
+
+        Every row of a 2-D distance array is a separate simulation with its own
+        realization of the field. Galaxies are placed in random directions around
+        the observer at the origin.
+        """
+        distance = np.atleast_2d(distance)
+        vpec = np.empty(distance.shape)
+        for sim in range(distance.shape[0]):
+            velocity = self.realize(rng)
+            direction = rng.standard_normal((distance.shape[1],3))
+            direction /= np.linalg.norm(direction,axis=1)[:,None]
+            vpec[sim] = np.sum(self.interpolate(velocity,distance[sim,:,None]*direction)*direction,axis=1)
+        return vpec
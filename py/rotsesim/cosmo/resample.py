@@ -0,0 +1,114 @@
+"""
+rotsesim.cosmo.resample
+
+Bootstrap and jackknife H0 uncertainties for every simulated catalog.
+The replicas of all catalogs are built as index (bootstrap) or mask
+(jackknife) matrices and fit together with fit_h0_batch, warm started
+from the fit to the full catalog, instead of one ODR run per replica.
+"""
+
+import numpy as np
+from scipy.special import ndtri
+
+from rotsesim.cosmo.galsim import fit_h0_batch
+
+def bootstrap_indices(rng,nsim,nboot,ngal):
+    """
+    (nsim, nboot, ngal) matrix of galaxies drawn with replacement for each bootstrap replica
+    """
+    return rng.integers(0,ngal,size=(nsim,nboot,ngal))
+
+def jackknife_mask(ngal):
+    """
+    (ngal, ngal) boolean matrix whose row i keeps every galaxy except galaxy i
+    """
+    return ~np.eye(ngal,dtype=bool)
+
+def resample_fit(distance,disterr,velocity,velerr,beta,index=None,mask=None,method='batch'):
+    """
+    Fit h0 to (nsim, nrep, ngal) replicas of (nsim, ngal) catalogs, returning (nsim, nrep) fit h0
+
+    Replicas are given by galaxy indices into each catalog (index) or by a
+    boolean mask of the galaxies kept (mask, broadcast against the replicas).
+    """
+    nsim, ngal = distance.shape
+    disterr = np.broadcast_to(disterr,distance.shape)
+    nrep = index.shape[1] if index is not None else mask.shape[-2]
+    if index is not None:
+        rows = np.arange(nsim)[:,None,None]
+        distance, disterr, velocity = distance[rows,index], disterr[rows,index], velocity[rows,index]
+        if velerr is not None and np.ndim(velerr) == 2:
+            velerr = velerr[rows,index]
+    else:
+        distance, disterr, velocity = [np.broadcast_to(a[:,None,:],(nsim,nrep,ngal)) for a in (distance,disterr,velocity)]
+        if velerr is not None and np.ndim(velerr) == 2:
+            velerr = np.broadcast_to(velerr[:,None,:],(nsim,nrep,ngal))
+        mask = np.broadcast_to(mask,(nsim,nrep,ngal)).reshape(nsim*nrep,ngal)
+    if velerr is not None and np.ndim(velerr) > 0:
+        velerr = np.reshape(velerr,(nsim*nrep,ngal))
+
+    shape = (nsim*nrep,ngal)
+    fith0 = fit_h0_batch(distance.reshape(shape),disterr.reshape(shape),velocity.reshape(shape),velerr,
+                         beta=np.repeat(beta,nrep),method=method,mask=mask)[0]
+    return fith0.reshape(nsim,nrep)
+
+def bootstrap_h0(distance,disterr,velocity,velerr=None,nboot=1000,level=0.68,seed=None,chunk=None,method='batch'):
+    """
+    Bootstrap H0 uncertainties of every catalog in (nsim, ngal) arrays
+
+    Each catalog is resampled nboot times with replacement and refit. With chunk,
+    only that many catalogs are resampled at a time, bounding memory at about
+    chunk*nboot*ngal values per array.
+    Returns the fit h0 of each full catalog, the standard deviation of its
+    bootstrap h0 values, and the lower and upper percentile bounds of the central
+    level interval, all as (nsim,) arrays.
+    """
+    distance, velocity = np.atleast_2d(distance), np.atleast_2d(velocity)
+    nsim, ngal = distance.shape
+    disterr = np.broadcast_to(disterr,distance.shape)
+    rng = np.random.default_rng(seed)
+    fith0 = fit_h0_batch(distance,disterr,velocity,velerr,method=method)[0]
+    if chunk is None:
+        chunk = nsim
+
+    h0std = np.empty(nsim)
+    low   = np.empty(nsim)
+    high  = np.empty(nsim)
+    percentiles = [50.*(1. - level),50.*(1. + level)]
+    for start in range(0,nsim,chunk):
+        sims = slice(start,min(start + chunk,nsim))
+        n = sims.stop - sims.start
+        ve = velerr[sims] if velerr is not None and np.ndim(velerr) == 2 else velerr
+        h0boot = resample_fit(distance[sims],disterr[sims],velocity[sims],ve,fith0[sims],
+                              index=bootstrap_indices(rng,n,nboot,ngal),method=method)
+        h0std[sims] = np.std(h0boot,axis=1,ddof=1)
+        low[sims], high[sims] = np.percentile(h0boot,percentiles,axis=1)
+
+    return fith0,h0std,low,high
+
+def jackknife_h0(distance,disterr,velocity,velerr=None,level=0.68,chunk=None,method='batch'):
+    """
+    Jackknife H0 uncertainties of every catalog in (nsim, ngal) arrays
+
+    Each catalog is refit ngal times leaving out one galaxy. Returns the fit h0
+    of each full catalog, its jackknife standard error
+    sqrt((ngal-1)/ngal * sum((h0_i - mean(h0_i))**2)), and the bounds of the central
+    level interval h0 -+ z*error, all as (nsim,) arrays.
+    """
+    distance, velocity = np.atleast_2d(distance), np.atleast_2d(velocity)
+    nsim, ngal = distance.shape
+    disterr = np.broadcast_to(disterr,distance.shape)
+    fith0 = fit_h0_batch(distance,disterr,velocity,velerr,method=method)[0]
+    mask = jackknife_mask(ngal)
+    if chunk is None:
+        chunk = nsim
+
+    h0err = np.empty(nsim)
+    for start in range(0,nsim,chunk):
+        sims = slice(start,min(start + chunk,nsim))
+        ve = velerr[sims] if velerr is not None and np.ndim(velerr) == 2 else velerr
+        h0jack = resample_fit(distance[sims],disterr[sims],velocity[sims],ve,fith0[sims],mask=mask,method=method)
+        h0err[sims] = np.sqrt((ngal - 1.)/ngal*np.sum((h0jack - np.mean(h0jack,axis=1)[:,None])**2,axis=1))
+
+    z = ndtri(0.5*(1. + level))
+    return fith0,h0err,fith0 - z*h0err,fith0 + z*h0err
@@ -0,0 +1,116 @@
+"""
+rotsesim.cosmo.sweep
+
+Run pecvel_sim over a grid of h0, pecvel, ngal, distance range and
+distance error values in one process pool, caching the summary of
+each grid point on disk so interrupted sweeps resume where they stopped.
+"""
+
+import hashlib
+import inspect
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from rotsesim.cosmo import galsim
+
+#- Values used for any parameter the grid specification leaves out
+grid_defaults = {'h0': [70.], 'pecvel': [300.], 'ngal': [10], 'distance': [[5.,30.]], 'disterr': [[0.2,0.05]]}
+
+def read_grid(filename):
+    """
+    Read a JSON grid specification, mapping parameter names to lists of values
+    """
+    with open(filename) as f:
+        grid = json.load(f)
+    unknown = set(grid) - set(grid_defaults)
+    if unknown:
+        raise ValueError("Unknown grid parameters {}".format(sorted(unknown)))
+    return grid
+
+def grid_points(grid):
+    """
+    Expand a grid specification into a list of parameter dictionaries
+    """
+    names  = list(grid_defaults)
+    values = [grid.get(name,grid_defaults[name]) for name in names]
+    points = [dict(zip(names,point)) for point in itertools.product(*values)]
+    for point in points:
+        point['ngal'] = int(point['ngal'])
+    return points
+
+def code_version():
+    """
+    Hash of the galsim source, so cached results are not reused after the code changes
+    """
+    return hashlib.sha1(inspect.getsource(galsim).encode()).hexdigest()[:12]
+
+def point_key(point,settings,version):
+    """
+    Cache key of a grid point for the given run settings and code version
+    """
+    text = json.dumps({'point': point, 'settings': settings, 'version': version},sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def run_point(point,settings,cachefile):
+    """
+    Run pecvel_sim for one grid point and store its summary in cachefile
+    """
+    summary = galsim.pecvel_sim(point['h0'],point['distance'],point['disterr'],point['pecvel'],point['ngal'],
+                                settings['nsim'],settings['iterations'],False,False,settings['seed'],
+                                method=settings['method'],blocksize=settings['blocksize'],stream=True,verbose=False)
+    result = {'point': point, 'settings': settings, 'summary': summary}
+
+    #- Write to a temporary file first so a crash never leaves a partial cache entry
+    tmpfile = cachefile + '.tmp{}'.format(os.getpid())
+    with open(tmpfile,'w') as f:
+        json.dump(result,f)
+    os.replace(tmpfile,cachefile)
+    return result
+
+def run_sweep(grid,nsim,iterations,seed,cachedir,workers=1,method='batch',blocksize=1000):
+    """
+    Run every grid point not already in cachedir, in a process pool if workers > 1
+
+    Every point uses the same seed. Returns the results of all grid points in grid order.
+    """
+    settings = {'nsim': nsim, 'iterations': iterations, 'seed': seed, 'method': method, 'blocksize': blocksize}
+    version  = code_version()
+    os.makedirs(cachedir,exist_ok=True)
+
+    points  = grid_points(grid)
+    files   = [os.path.join(cachedir,point_key(point,settings,version) + '.json') for point in points]
+    results = [None]*len(points)
+    todo    = []
+    for i, cachefile in enumerate(files):
+        if os.path.exists(cachefile):
+            with open(cachefile) as f:
+                results[i] = json.load(f)
+        else:
+            todo.append(i)
+    print("{} grid points, {} cached, {} to run".format(len(points),len(points) - len(todo),len(todo)))
+
+    if workers is None or workers <= 1:
+        for i in todo:
+            results[i] = run_point(points[i],settings,files[i])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(run_point,points[i],settings,files[i]): i for i in todo}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+    return results
+
+def print_sweep(results):
+    """
+    Print the final h0 average, rms, error and chi2 of each grid point
+    """
+    print("{:>8s} {:>8s} {:>6s} {:>13s} {:>13s} {:>10s} {:>8s} {:>8s} {:>8s}".format(
+          'h0','pecvel','ngal','distance','disterr','H0 avg','rms','err','chi2'))
+    for result in results:
+        point, summary = result['point'], result['summary']
+        print("{:8.2f} {:8.2f} {:6d} {:>13s} {:>13s} {:10.4f} {:8.4f} {:8.4f} {:8.4f}".format(
+              point['h0'],point['pecvel'],point['ngal'],
+              '{:g}-{:g}'.format(*point['distance']),'{:g},{:g}'.format(*point['disterr']),
+              summary['h0mean'][-1],summary['h0std'][-1],summary['h0errmean'][-1],summary['chi2mean'][-1]))
@@ -0,0 +1,145 @@
+"""
+rotsesim.mesa
+
+Read MESA history output, either the native whitespace-separated
+history.data format or a comma-separated CSV copy of it. Only the requested
+columns are parsed, with explicit dtypes, in chunks; the parsed columns are
+cached as a structured .npy file so later reads memory-map it instantly.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+
+import numpy as np
+
+#- Directory for cached histories; they never go next to the inputs, which are often read as a directory of stars
+history_cache = os.path.join(os.path.expanduser('~'),'.cache','rotsesim','mesa')
+
+#- history.data has five lines of file header (numbers, names, values, blank, column numbers) before the column names
+mesa_header_lines = 5
+
+def history_format(filename):
+    """
+    'csv' if the first line of the file is comma separated, otherwise 'mesa' (history.data layout)
+    """
+    with open(filename,encoding='utf-8-sig') as f:
+        return 'csv' if ',' in f.readline() else 'mesa'
+
+def history_columns(filename):
+    """
+    Names of all the columns of a MESA history file
+    """
+    with open(filename,encoding='utf-8-sig') as f:
+        if history_format(filename) == 'csv':
+            return [name.strip() for name in f.readline().split(',')]
+        for i in range(mesa_header_lines):
+            f.readline()
+        return f.readline().split()
+
+def iter_history(filename,columns=None,dtypes=None,chunksize=100000):
+    """
+    Iterate over a MESA history file as pandas DataFrames of at most chunksize rows
+
+    Only the listed columns are parsed (all columns if None); dtypes maps column names
+    to dtypes, and every other column is read as float64.
+    """
+    import pandas as pd
+
+    if columns is None:
+        columns = history_columns(filename)
+    dtype = {name: np.dtype((dtypes or {}).get(name,np.float64)) for name in columns}
+    if history_format(filename) == 'csv':
+        options = dict(sep=',')
+    else:
+        options = dict(sep=r'\s+',skiprows=mesa_header_lines)
+    reader = pd.read_csv(filename,usecols=list(columns),dtype=dtype,chunksize=chunksize,encoding='utf-8-sig',**options)
+    for chunk in reader:
+        yield chunk[list(columns)]
+
+def cache_file(filename,columns,dtypes,cachedir=history_cache):
+    """
+    Cache file name of a history, keyed by its path, size and modification time and the columns and dtypes read
+    """
+    stat = os.stat(filename)
+    key = json.dumps({'path': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                      'columns': list(columns), 'dtypes': [np.dtype(dtypes.get(name,np.float64)).str for name in columns]})
+    name = os.path.basename(filename) + '.' + hashlib.sha1(key.encode()).hexdigest()[:16] + '.npy'
+    return os.path.join(cachedir,name)
+
+def count_lines(filename):
+    """
+    Number of newlines in a text file, read through gzip if the name ends in .gz
+    """
+    nlines = 0
+    with (gzip.open if filename.lower().endswith('.gz') else open)(filename,'rb') as f:
+        for block in iter(lambda: f.read(2**24),b''):
+            nlines += block.count(b'\n')
+    return nlines
+
+def write_chunks(filename,chunks,dtype,maxrows,chunksize=100000):
+    """
+    Write DataFrame chunks into a structured .npy file with the fields of dtype, without holding them all in memory
+
+    The chunks are copied field by field into a memory-mapped file of maxrows rows (an
+    upper bound such as the line count of the source), which is then trimmed to the
+    rows written, chunksize rows at a time. The file is built under a temporary name
+    and moved into place at the end, so readers never see a partial file.
+    """
+    tmpfile = filename + '.tmp{}.npy'.format(os.getpid())
+    out = np.lib.format.open_memmap(tmpfile,mode='w+',dtype=dtype,shape=(maxrows,))
+    nrows = 0
+    for chunk in chunks:
+        for name in dtype.names:
+            out[name][nrows:nrows + len(chunk)] = chunk[name].to_numpy()
+        nrows += len(chunk)
+    out.flush()
+    del out
+
+    #- Trim the spare rows, copying in chunks
+    if nrows < maxrows:
+        full = np.load(tmpfile,mmap_mode='r')
+        trimfile = tmpfile + '.trim.npy'
+        out = np.lib.format.open_memmap(trimfile,mode='w+',dtype=dtype,shape=(nrows,))
+        for start in range(0,nrows,chunksize):
+            stop = min(start + chunksize,nrows)
+            out[start:stop] = full[start:stop]
+        out.flush()
+        del out, full
+        os.replace(trimfile,tmpfile)
+    os.replace(tmpfile,filename)
+
+def read_history(filename,columns=None,dtypes=None,cache=True,cachedir=history_cache,chunksize=100000):
+    """
+    Read the listed columns of a MESA history file into a structured array
+
+    The file is parsed chunksize rows at a time straight into a structured .npy file
+    in cachedir, which is memory-mapped and returned. Later reads of the same columns
+    from an unchanged file memory-map the cache without parsing. With cache=False the
+    columns are parsed into memory instead. Columns are float64 unless dtypes says otherwise.
+    """
+    if columns is None:
+        columns = history_columns(filename)
+    dtypes = dtypes or {}
+    dtype = np.dtype([(name,dtypes.get(name,np.float64)) for name in columns])
+    if not cache:
+        chunks = [chunk.to_records(index=False).astype(dtype) for chunk in iter_history(filename,columns,dtypes,chunksize)]
+        return np.concatenate(chunks) if chunks else np.empty(0,dtype=dtype)
+
+    cachefile = cache_file(filename,columns,dtypes,cachedir)
+    if os.path.exists(cachefile):
+        return np.load(cachefile,mmap_mode='r')
+
+    os.makedirs(cachedir,exist_ok=True)
+    write_chunks(cachefile,iter_history(filename,columns,dtypes,chunksize),dtype,count_lines(filename) + 1,chunksize)
+    return np.load(cachefile,mmap_mode='r')
+
+def history_frame(filename,columns=None,dtypes=None,cache=True,cachedir=history_cache):
+    """
+    Read the listed columns of a MESA history file (see read_history) as a pandas DataFrame
+    """
+    import pandas as pd
+
+    history = read_history(filename,columns,dtypes,cache=cache,cachedir=cachedir)
+    return pd.DataFrame({name: np.asarray(history[name]) for name in history.dtype.names})
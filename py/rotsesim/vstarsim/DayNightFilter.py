@@ -13,10 +13,116 @@ import configparser
 import numpy as np
 
 class DayNightFilter:
-    def filter_night_entries(df: pd.DataFrame, start_date: datetime, end_date: datetime, latitude: str, longitude: str, obsLocationElevation: float):
+    def night_intervals(start_date: datetime, end_date: datetime, latitude: str, longitude: str, obsLocationElevation: float, horizon: float = 0., use_center: bool = False):
         """
-            This functions is calculating the elevation of the star at the moment of each observation in the input dataframe.
-            Then, it removes all observations below a threshold.
+            This function calculates the sunset and the following sunrise of every night between start_date and end_date, once per night.
+            
+            Parameters
+            ----------
+            start_date: datetime
+                The first date the nights are calculated for. The night in progress at start_date is included.
+                
+            end_date: datetime
+                The last date the nights are calculated for. The night in progress at end_date is included.
+            
+            latitude : str
+                Latitude of the observation location
+                
+            longitude : str
+                Longitude of the observation location
+                
+            obsLocationElevation : float
+                Elevation of the observation location
+                
+            horizon : float
+                The altitude of the sun in degrees at which the night starts and ends. 0 is the usual sunset and sunrise,
+                -18 is astronomical twilight (with use_center = True).
+                
+            use_center : bool
+                If True, the night starts and ends when the center of the sun crosses the horizon (as twilight is defined),
+                otherwise when its upper limb does (as sunset and sunrise are defined).
+                
+            Returns
+            -------
+            np.ndarray
+                A (nights, 2) array of the sunset and sunrise of every night, as ephem dates (days since 1899/12/31 12:00 UTC).
+            
+        """
+        observer = ephem.Observer()
+        observer.lat = latitude
+        observer.lon = longitude
+        observer.elevation = obsLocationElevation
+        observer.horizon = str(horizon)
+        sun = ephem.Sun()
+        
+        start = DayNightFilter.ephem_date(start_date)
+        end = DayNightFilter.ephem_date(end_date)
+        t = start - 1 # start a day early to include the night in progress at start_date
+        nights = []
+        while t <= end:
+            observer.date = t
+            try:
+                setting = observer.next_setting(sun, use_center=use_center)
+                observer.date = setting
+                rising = observer.next_rising(sun, use_center=use_center)
+            except ephem.NeverUpError: ## the sun stays below the horizon for the whole day, so the day is part of the night
+                setting, rising = t, t + 1
+            except ephem.AlwaysUpError: ## the sun stays above the horizon, so there is no night on this day
+                t = t + 1
+                continue
+            nights.append((float(setting), float(rising)))
+            t = rising
+        return np.array(nights).reshape(-1, 2)
+    
+    def ephem_date(date: datetime):
+        """
+            Converts a datetime (with or without a timezone; without one it is taken to be UTC) to an ephem date.
+        """
+        if date.tzinfo is not None:
+            date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return float(ephem.Date(date))
+    
+    def observation_times(start_date: datetime, days: np.ndarray):
+        """
+            Calculates the time of every observation as start_date + timedelta(days=day), the wall-clock convention used by
+            the other filters and the scheduler: the days are added to the local date and time, and the result takes the UTC
+            offset in force at that local time (so across a daylight saving change it moves by an hour in absolute time).
+            
+            Parameters
+            ----------
+            start_date: datetime
+                The start of the simulation, with or without a timezone (without one it is taken to be UTC).
+                
+            days : np.ndarray
+                The day offsets (star_age_day) of the observations.
+                
+            Returns
+            -------
+            (pd.DatetimeIndex, np.ndarray)
+                The local time of every observation, and the same times as ephem dates.
+            
+        """
+        wall = pd.Timestamp(start_date.replace(tzinfo=None)) + pd.to_timedelta(days, unit='D')
+        if start_date.tzinfo is None:
+            return wall, DayNightFilter.ephem_date(start_date.replace(tzinfo=None)) + np.asarray(days, dtype=float)
+        local = wall.tz_localize(start_date.tzinfo, ambiguous='NaT', nonexistent='NaT')
+        utc = local.tz_convert('UTC').tz_localize(None)
+        ## Local times repeated or skipped by a daylight saving change are resolved one by one, as datetime does it
+        odd = np.flatnonzero(local.isna())
+        if len(odd) > 0:
+            fixed = [start_date + datetime.timedelta(days=float(days[i])) for i in odd]
+            utc = utc.array.copy()
+            utc[odd] = [pd.Timestamp(t.astimezone(datetime.timezone.utc).replace(tzinfo=None)) for t in fixed]
+            utc = pd.DatetimeIndex(utc)
+            local = utc.tz_localize('UTC').tz_convert(start_date.tzinfo)
+        times = (utc - pd.Timestamp('1899-12-31 12:00:00'))/pd.Timedelta(days=1)
+        return local, np.asarray(times, dtype=float)
+    
+    def filter_night_entries(df: pd.DataFrame, start_date: datetime, end_date: datetime, latitude: str, longitude: str, obsLocationElevation: float, horizon: float = 0., use_center: bool = False):
+        """
+            This functions finds whether each observation in the input dataframe happens at night and removes all daytime observations.
+            The sunsets and sunrises are calculated once per night with night_intervals, and all the observations are then
+            placed between them at once.
             
             Parameters
             ----------
@@ -40,6 +146,12 @@ class DayNightFilter:
             obsLocationElevation : float
                 Elevation of the observation location
                 
+            horizon : float
+                The altitude of the sun in degrees below which it is night (0 by default, -18 for astronomical twilight).
+                
+            use_center : bool
+                Whether the center (True) or the upper limb (False) of the sun is compared to the horizon.
+                
             Returns
             -------
             DataFrame
@@ -47,32 +159,19 @@ class DayNightFilter:
                 is during nighttime (which wil be true for all rows since we are removing all daytime observations)
             
         """
+        ## Calculate the current time of every observation based on the start_date and the day offset from the simulation
+        days = df['star_age_day'].to_numpy(dtype=float)
+        currentTimes, times = DayNightFilter.observation_times(start_date, days)
+        df['CurrentTime'] = currentTimes
         
-        ## Create the Observer object and assign coordinates of the observation location
-        observer = ephem.Observer()
-        observer.lat = latitude
-        observer.lon = longitude
-        observer.elevation = obsLocationElevation
+        ## Calculate the nights once for the whole range of the observations
+        first = start_date + datetime.timedelta(days=float(np.min(days, initial=0.)))
+        last = start_date + datetime.timedelta(days=float(np.max(days, initial=0.)))
+        nights = DayNightFilter.night_intervals(first, last, latitude, longitude, obsLocationElevation, horizon, use_center)
         
-        ## Create a new column containing a boolean that shows whether it is day or night. Assign False initially.
-        df['night_time'] = False
-        df['CurrentTime'] = np.nan
-        ## Go observation by observation
-        for i, row in df.iterrows():
-            ## Calculate the current time based on the start_date and the day offset from the simulation
-            currentTime = start_date + datetime.timedelta(days=row['star_age_day'])
-            df.at[i, 'CurrentTime'] = currentTime
-            ## set the date at the observation location to be currentTime
-            observer.date = currentTime # The currentTime is automatically converted to UTC (it knows how to do it because the start_date contains information about the timezone of the observation location. 
-            # I would recommend just setting timezone to UTC directly in the config since this is what astronomers use anyway.
-
-            ## Set the night_time column value equal to true for the current row if the previous_rising is NOT later than the previous_setting
-            ## We had to resort to this condition because checking whether the current time is between the previous_setting and next_rising
-            ## would always return true.
-            if not(observer.previous_rising(ephem.Sun()) > observer.previous_setting(ephem.Sun())):            
-                df.at[i, 'night_time'] = True
-                # print(currentTime)
+        ## An observation is at night if the last sunset or sunrise before it is a sunset, i.e. if it falls after an odd number of them
+        df['night_time'] = np.searchsorted(nights.ravel(), times, side='right') % 2 == 1
                 
         ## Keep only the nighttime observations     
         df = df[df['night_time'] == True]
-        return df
\ No newline at end of file
+        return df
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Simulates the counts ROTSE-III records in each scheduled exposure from the photon rate of the star.
+"""
+
+import numpy as np
+import pandas as pd
+import Star
+
+class ExposureSimulator:
+    def IntegrateRate(times: np.ndarray, rateTimes: np.ndarray, rates: np.ndarray, exposureTime: float):
+        """
+            This function integrates a photon rate over exposure windows. The rate is linear between the times it is given at
+            (and constant beyond them), so its integral is piecewise quadratic and is evaluated exactly from the cumulative
+            integral at the start and end of every window.
+
+            Parameters
+            ----------
+            times : np.ndarray
+                The mid-exposure times in days (star_age_day).
+
+            rateTimes : np.ndarray
+                The times in days at which the photon rate is given, in increasing order.
+
+            rates : np.ndarray
+                The photon rate in photons/second at rateTimes.
+
+            exposureTime : float
+                The length of each exposure in seconds.
+
+            Returns
+            -------
+            np.ndarray
+                The expected number of photons collected during each exposure.
+
+        """
+        seconds = (np.asarray(rateTimes, dtype=float) - rateTimes[0])*86400 # rate times in seconds since the first one
+        rates = np.asarray(rates, dtype=float)
+        slopes = np.diff(rates)/np.diff(seconds)
+        cumulative = np.concatenate([[0.], np.cumsum(0.5*(rates[1:] + rates[:-1])*np.diff(seconds))]) # integral of the rate up to each rate time
+
+        def integral(x): # integral of the rate from the first rate time to x (seconds), constant rate outside the tabulated range
+            i = np.clip(np.searchsorted(seconds, x, side='right') - 1, 0, len(seconds) - 2)
+            dx = x - seconds[i]
+            inside = cumulative[i] + rates[i]*dx + 0.5*slopes[i]*dx**2
+            before = rates[0]*x
+            after = cumulative[-1] + rates[-1]*(x - seconds[-1])
+            return np.where(x < seconds[0], before, np.where(x > seconds[-1], after, inside))
+
+        middle = (np.asarray(times, dtype=float) - rateTimes[0])*86400
+        return integral(middle + 0.5*exposureTime) - integral(middle - 0.5*exposureTime)
+
+    def SimulateExposures(stars: list[Star], exposureTime: float = 60., skyRate: float = 0., seed: int = None, chunk: int = 1000000):
+        """
+            This function simulates the counts of every scheduled exposure of every star. Each exposure integrates the photon rate
+            of the star (the 'luminosity' column of its original data, in photons/second when the photon model is used) over
+            exposureTime seconds centered on the scheduled time, and the source and sky photons are drawn from Poisson distributions
+            for a whole chunk of exposures at once. The chunks are yielded one by one, so any number of exposures can be simulated
+            in bounded memory.
+
+            Parameters
+            ----------
+            stars : list[Star]
+                The star objects, with the scheduled observations in their interpolated data (set by the RotseIIIScheduler).
+
+            exposureTime : float
+                The length of each exposure in seconds (60 for ROTSE-III).
+
+            skyRate : float
+                The photons/second from the sky background collected with the star in each exposure.
+
+            seed : int
+                Seed of the random numbers. The source and sky counts come from separate streams of the seed, so the counts do
+                not depend on the chunk size.
+
+            chunk : int
+                The number of exposures simulated at a time.
+
+            Returns
+            -------
+            Generator of DataFrames
+                One DataFrame per chunk of exposures, with the columns star (index of the star in stars), star_age_day,
+                expected (expected source photons), source_counts, sky_counts and counts (source plus sky).
+
+        """
+        sourceSeed, skySeed = np.random.SeedSequence(seed).spawn(2)
+        sourceRng = np.random.default_rng(sourceSeed)
+        skyRng = np.random.default_rng(skySeed)
+        pieces = [] # pieces of the current chunk: (star index, times, expected photons)
+        size = 0
+
+        def draw(pieces): # Poisson counts of all the exposures in the pieces in one batch
+            starIndex = np.concatenate([np.full(len(t), s) for s, t, e in pieces])
+            times = np.concatenate([t for s, t, e in pieces])
+            expected = np.concatenate([e for s, t, e in pieces])
+            sourceCounts = sourceRng.poisson(expected)
+            skyCounts = skyRng.poisson(skyRate*exposureTime, size=len(expected))
+            return pd.DataFrame({'star': starIndex, 'star_age_day': times, 'expected': expected, 'source_counts': sourceCounts, 'sky_counts': skyCounts, 'counts': sourceCounts + skyCounts})
+
+        for s, star in enumerate(stars):
+            model = star.getOriginalData()
+            rateTimes = model['star_age_day'].to_numpy(dtype=float)
+            rates = model['luminosity'].to_numpy(dtype=float)
+            times = np.asarray(star.getInterpolatedData()['star_age_day'], dtype=float)
+            start = 0
+            while start < len(times): # fill the current chunk with the exposures of this star, yielding it whenever it is full
+                block = times[start:start + chunk - size]
+                pieces.append((s, block, ExposureSimulator.IntegrateRate(block, rateTimes, rates, exposureTime)))
+                size += len(block)
+                start += len(block)
+                if size == chunk:
+                    yield draw(pieces)
+                    pieces, size = [], 0
+        if size > 0:
+            yield draw(pieces)
@@ -19,6 +19,7 @@ import DayNightFilter
 import ElevationFilter
 from scipy.interpolate import CubicSpline
 import RotseIIIScheduler
+import ExposureSimulator
 
 class ObservationTimes:
     """
@@ -44,6 +45,27 @@ class ObservationTimes:
     - __excel_files_location : str
         The location of the Excel files with MESA outputs.
         
+    - __photonRates : bool
+        Whether the stars carry photon rates on the ROTSE-III CCD from the cepheid photon model instead of luminosities.
+        
+    - __photonColumns : list
+        The radius, effective temperature and time columns read for the photon model.
+        
+    - __responseCurve : str
+        Optional response curve table the photon rates are weighted by.
+        
+    - __simulateExposures : bool
+        Whether the counts of every scheduled exposure are simulated and written to ExposureOutput.csv.
+        
+    - __exposureTime : float
+        The length of each exposure in seconds.
+        
+    - __skyRate : float
+        The photons/second of sky background in each exposure.
+        
+    - __exposureSeed : int
+        Seed of the simulated counts.
+        
     - __obsLocationLatitude : str
         The latitude of the observation location.
         
@@ -62,6 +84,12 @@ class ObservationTimes:
     - __elevationThreshold : float
         The elevation threshold for filtering observations.
         
+    - __sunHorizon : float
+        The altitude of the sun in degrees below which it is night (-18 for astronomical twilight).
+        
+    - __useSunCenter : bool
+        Whether the center or the upper limb of the sun is compared to sunHorizon.
+        
     - __StarsArray : list 
         A list of Star objects generated by the StarGenerator.
         
@@ -103,6 +131,18 @@ class ObservationTimes:
         ## ExcelFilesLocations
         self.__excel_files_location = config["ExcelFilesLocations"]["mesaOutputs"]
         
+        ## PhotonModel (optional section; without it the MESA luminosity is used)
+        self.__photonRates = config.getboolean("PhotonModel", "photonRates", fallback=False)
+        self.__photonColumns = config.get("PhotonModel", "columns", fallback="Rstar Teff star_age_day").split()
+        self.__responseCurve = config.get("PhotonModel", "responseCurve", fallback="") or None
+        
+        ## ExposureParameters (optional section; without it no exposures are simulated)
+        self.__simulateExposures = config.getboolean("ExposureParameters", "simulateExposures", fallback=False)
+        self.__exposureTime = config.getfloat("ExposureParameters", "exposureTime", fallback=60.)
+        self.__skyRate = config.getfloat("ExposureParameters", "skyRate", fallback=0.)
+        seed = config.get("ExposureParameters", "seed", fallback="")
+        self.__exposureSeed = int(seed) if seed else None
+        
         ## ObservationLocationInfo
         self.__obsLocationLatitude = config["ObservationLocationInfo"]["latitude"]
         self.__obsLocationLongitude = config["ObservationLocationInfo"]["longitude"]
@@ -115,6 +155,8 @@ class ObservationTimes:
         
         ## FilteringParameters
         self.__elevationThreshold = float(config["FilteringParameters"]["elevationThreshold"])
+        self.__sunHorizon = config.getfloat("FilteringParameters", "sunHorizon", fallback=0.)
+        self.__useSunCenter = config.getboolean("FilteringParameters", "useSunCenter", fallback=False)
         
         ## Attach the local timezone of the obeservation location to the start_date and end_date member variables
         timeZone = ZoneInfo(self.__obsLocationTimeZone)
@@ -122,7 +164,7 @@ class ObservationTimes:
         self.__end_date = self.__end_date.replace(tzinfo=timeZone)
         
         ## Generate coordinates for the star and read the data
-        self.__StarsArray = StarGenerator.StarGenerator.GenerateStars(self.__field_center_ra, self.__field_center_dec, self.__fov, self.__min_star_separation, self.__excel_files_location, self.__instaSolarLuminosity)
+        self.__StarsArray = StarGenerator.StarGenerator.GenerateStars(self.__field_center_ra, self.__field_center_dec, self.__fov, self.__min_star_separation, self.__excel_files_location, self.__instaSolarLuminosity, photonRates=self.__photonRates, photonColumns=self.__photonColumns, responseCurve=self.__responseCurve)
         
         ## Plot the stars in the sky
         StarGenerator.StarGenerator.plot_stars(self.__StarsArray)
@@ -142,7 +184,7 @@ class ObservationTimes:
                 ax = star.getData().plot.line(x = 'star_age_day', y = 'luminosity', )
                 ax.set_xlim(2150,2200)
             ## Filter all the days out of the DataFrame
-            star.setData( DayNightFilter.DayNightFilter.filter_night_entries(star.getData(), self.__start_date, self.__end_date, self.__obsLocationLatitude, self.__obsLocationLongitude, self.__obsLocationElevation))
+            star.setData( DayNightFilter.DayNightFilter.filter_night_entries(star.getData(), self.__start_date, self.__end_date, self.__obsLocationLatitude, self.__obsLocationLongitude, self.__obsLocationElevation, self.__sunHorizon, self.__useSunCenter))
             if(self.__verbose):
                 print("Data after DayNight filtration")
                 print(star.getData())
@@ -189,6 +231,12 @@ class ObservationTimes:
                 # ax.set_ylim(0.5e18,1e18)
             #Output to a csv file
             star.getInterpolatedData().to_csv('SchedulerOutput.csv', index=True)
+        
+        ## Simulate the counts of every scheduled exposure, streaming them to a csv file a chunk at a time
+        if(self.__simulateExposures):
+            exposures = ExposureSimulator.ExposureSimulator.SimulateExposures(self.__StarsArray, self.__exposureTime, self.__skyRate, self.__exposureSeed)
+            for i, chunk in enumerate(exposures):
+                chunk.to_csv('ExposureOutput.csv', index=False, mode='w' if i == 0 else 'a', header=(i == 0))
             
     def getStarsArray(self):
         return self.__StarsArray
@@ -10,9 +10,11 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import Star
 import os
+from rotsesim.mesa import history_frame
+from rotsesim.cepheid import phot_per_sec
 
 class StarGenerator:
-    def GenerateStars(field_center_ra: float, field_center_dec: float, fov: float, min_star_separation: float, excel_files_location: str, instaSolarLuminosity: float):
+    def GenerateStars(field_center_ra: float, field_center_dec: float, fov: float, min_star_separation: float, excel_files_location: str, instaSolarLuminosity: float, columns: list = ['star_age_day', 'luminosity'], photonRates: bool = False, photonColumns: list = ['Rstar', 'Teff', 'star_age_day'], responseCurve: str = None):
         """
             This functions is getting all csv files in a folder specified in the config file and then for each excel file (one excel file = one star)
             it reads the data, assigns coordinates to the star in the field of view and then creats a star object that is added to the array it returns.
@@ -36,6 +38,24 @@ class StarGenerator:
                 
             instaSolarLuminosity: float
                 A constant that represents the instant solar luminosity. This is used to convert the luminosity given my MESA to solar units.
+                
+            columns: list
+                The MESA history columns to read from each file (csv or history.data). Only these columns are parsed, and they are cached
+                so that later runs on the same files load instantly. Must include 'luminosity'.
+                
+            photonRates: bool
+                If True, the radius and effective temperature of each file are passed through the cepheid photon model
+                (phot_per_sec.photon_rates) in memory, and the 'luminosity' column of each star holds the photons/second reaching
+                the ROTSE-III CCD instead of the MESA luminosity scaled by instaSolarLuminosity. The Rstar and Teff columns are kept.
+                The filters and the scheduler then work on photon rates unchanged.
+                
+            photonColumns: list
+                The columns holding the radius, effective temperature and time of each row when photonRates is True
+                (radius, effective_T and star_age_day in history.data).
+                
+            responseCurve: str
+                Optional table of the CCD response (wavelength and response columns, e.g. rotse_response_normalized.ecsv). When given
+                with photonRates, the photon rates are weighted by this response.
             
             Returns
             -------
@@ -44,13 +64,20 @@ class StarGenerator:
             
         """
         stars = []
+        response = None
+        if photonRates and responseCurve:
+            response = phot_per_sec.response_matrix([phot_per_sec.read_response(responseCurve)])
     
         for filename in os.listdir(excel_files_location): # go through each csv file (star)
             overlap = True
             f = os.path.join(excel_files_location, filename) # f is the full path that refers to the current file we are looking at
 
-            df = pd.read_csv(f, header = 0, low_memory=False) # read the data from the csv
-            df['luminosity'] = df['luminosity'] * instaSolarLuminosity ## convert the luminosity column to solar units
+            if photonRates:
+                df = phot_per_sec.photon_rates(f, photonColumns, response) # photons/second of each row from the radius and effective temperature
+                df = df.rename(columns={'photon_rate': 'luminosity'}) ## the filters and the scheduler work on the 'luminosity' column
+            else:
+                df = history_frame(f, columns) # read the needed columns of the MESA output
+                df['luminosity'] = df['luminosity'] * instaSolarLuminosity ## convert the luminosity column to solar units
             df = df.dropna() ## remove empty rows
             while overlap == True: ## generate new coordinates until they don't overalp with other stars
                 overlap = False